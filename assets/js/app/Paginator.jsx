@@ -1,9 +1,19 @@
 import React from 'react'
-import { Grid, Row, Col } from 'react-bootstrap'
+import { Grid, Row, Col, Pager } from 'react-bootstrap'
 import ReactPaginate from 'react-paginate'
 
 function Paginator(props) {
 
+  // Cursor-paginated lists only know whether there is a next/previous page
+  if (props.onCursorChange) {
+    return (
+      <Pager>
+        <Pager.Item previous disabled={!props.previous} onSelect={() => {if (props.previous) props.onCursorChange(props.previous)}}>&larr; {props.previousLabel || "Previous"}</Pager.Item>
+        <Pager.Item next disabled={!props.next} onSelect={() => {if (props.next) props.onCursorChange(props.next)}}>{props.nextLabel || "Next"} &rarr;</Pager.Item>
+      </Pager>
+    )
+  }
+
   return (
            <ReactPaginate previousLabel={"<"}
                    nextLabel={">"}
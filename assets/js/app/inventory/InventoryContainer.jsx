@@ -87,7 +87,13 @@ const InventoryContainer = React.createClass({
       page: this.state.page,
       itemsPerPage: this.state.itemsPerPage
     }
+    // ignore responses to searches that have since been replaced
+    var searchRequest = (this.searchRequest || 0) + 1
+    this.searchRequest = searchRequest
     getJSON(url, params, function(data) {
+      if (searchRequest != _this.searchRequest) {
+        return
+      }
       var item = _this.state.item
       _this.setState({
         item: item,
@@ -109,11 +115,27 @@ const InventoryContainer = React.createClass({
 
   handleSearch(e) {
     e.preventDefault()
+    clearTimeout(this.searchTimeout)
     this.setState({page: 1}, () => {
       this.getItems();
     });
   },
 
+  // wait until the user stops typing instead of searching on every keystroke
+  handleSearchInput(e) {
+    this.handleChange(e)
+    clearTimeout(this.searchTimeout)
+    this.searchTimeout = setTimeout(() => {
+      this.setState({page: 1}, () => {
+        this.getItems();
+      });
+    }, 300)
+  },
+
+  componentWillUnmount() {
+    clearTimeout(this.searchTimeout)
+  },
+
   createItem(e) {
     e.preventDefault()
     e.stopPropagation()
@@ -724,13 +746,13 @@ const InventoryContainer = React.createClass({
                       <Row>
                         <Col md={12}>
                           <FormGroup>
-                            <ControlLabel>Search by item name or model number</ControlLabel>
+                            <ControlLabel>Search items</ControlLabel>
                             <InputGroup bsSize="small">
-                              <FormControl placeholder="Item name or model number"
+                              <FormControl placeholder="Name, model number, description..."
                                            style={{fontSize:"12px"}}
                                            type="text" name="searchText"
                                            value={this.state.searchText}
-                                           onChange={e => {this.handleChange(e); this.handleSearch(e);}}/>
+                                           onChange={this.handleSearchInput}/>
                               <InputGroup.Addon style={{backgroundColor: "#df691a"}} className="clickable" onClick={this.handleSearch}>
                                 <Glyphicon glyph="search"/>
                               </InputGroup.Addon>
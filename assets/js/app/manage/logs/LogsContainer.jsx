@@ -24,8 +24,10 @@ class LogsContainer extends Component {
       items: [],
       currentenddate: null,
       currentstartdate: null,
-      page: 1,
-      pageCount: 0,
+      // logs are paged with a cursor, the table is too big for page numbers
+      cursor: "",
+      next: null,
+      previous: null,
     }
     this.getAllLogs = this.getAllLogs.bind(this)
     this.filter = this.filter.bind(this)
@@ -37,7 +39,7 @@ class LogsContainer extends Component {
     this.getItems = this.getItems.bind(this)
     this.changeDate = this.changeDate.bind(this)
     this.clearSearch = this.clearSearch.bind(this)
-    this.handlePageClick = this.handlePageClick.bind(this)
+    this.handleCursorChange = this.handleCursorChange.bind(this)
 
     this.getAllLogs()
     this.getUsers()
@@ -85,7 +87,7 @@ class LogsContainer extends Component {
       startDate: null,
       endDate: null,
       item: null,
-      page: 1,
+      cursor: "",
       itemsPerPage: LOGS_PER_PAGE,
     }
     this.getLogs(params)
@@ -96,24 +98,25 @@ class LogsContainer extends Component {
     $.getJSON("/api/logs.json", params, function(data) {
       thisobj.setState({
         logs: data.results,
-        pageCount: Math.ceil(data.num_pages),
+        next: data.next,
+        previous: data.previous,
       });
     })
   }
 
   changeUser(event){
-    this.setState({currentuser: event, page: 1}, () => {this.filter();})
+    this.setState({currentuser: event, cursor: ""}, () => {this.filter();})
   }
 
   changeItem(event){
-    this.setState({currentitem: event, page: 1}, () => {this.filter();})
+    this.setState({currentitem: event, cursor: ""}, () => {this.filter();})
   }
 
   changeDate(event, picker){
     this.setState({
       currentstartdate: picker.startDate.toString(),
       currentenddate: picker.endDate.toString(),
-      page: 1
+      cursor: ""
     }, () => {this.filter();})
   }
 
@@ -123,7 +126,7 @@ class LogsContainer extends Component {
       currentstartdate: null,
       currentuser: null,
       currentitem: null,
-      page: 1
+      cursor: ""
     }, () => {this.getAllLogs()})
   }
 
@@ -133,18 +136,14 @@ class LogsContainer extends Component {
       item: this.state.currentitem,
       startDate: this.state.currentstartdate,
       endDate: this.state.currentenddate,
-      page: this.state.page,
+      cursor: this.state.cursor,
       itemsPerPage: LOGS_PER_PAGE,
     }
     this.getLogs(params);
   }
 
-  handlePageClick(data) {
-    let selected = data.selected;
-    let offset = Math.ceil(selected * LOGS_PER_PAGE);
-    let page = data.selected + 1;
-
-    this.setState({page: page}, () => {
+  handleCursorChange(cursor) {
+    this.setState({cursor: cursor}, () => {
       this.filter();
     });
   }
@@ -186,7 +185,8 @@ class LogsContainer extends Component {
         <Row>
           <Col sm={12}>
             <LogEntryContainer className="log-list" logs={this.state.logs} />
-            <Paginator pageCount={this.state.pageCount} onPageChange={this.handlePageClick} forcePage={this.state.page - 1}/>
+            <Paginator next={this.state.next} previous={this.state.previous} onCursorChange={this.handleCursorChange}
+                       previousLabel="Newer" nextLabel="Older"/>
           </Col>
         </Row>
         </Panel>
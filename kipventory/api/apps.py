@@ -1,5 +1,30 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+# Postgres-only indexes that can't be declared on the models. They are created
+# after every `migrate` instead of in a migration because resetdb.sh throws the
+# migrations away, so every statement here has to be safe to run again.
+POSTGRES_INDEXES = [
+    # Trigram indexes for item search (see search.py)
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS api_item_search_text_trgm ON api_item USING gin (search_text gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS api_item_name_trgm ON api_item USING gin (name gin_trgm_ops)",
+    # Most loans have been returned, so the outstanding ones are best found through a small partial index
+    "CREATE INDEX IF NOT EXISTS api_loan_outstanding_request ON api_loan (request_id) WHERE outstanding",
+]
+
+def create_postgres_indexes(sender, using='default', **kwargs):
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for statement in POSTGRES_INDEXES:
+            cursor.execute(statement)
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        post_migrate.connect(create_postgres_indexes, sender=self)
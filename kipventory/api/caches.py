@@ -0,0 +1,70 @@
+from django.db import transaction, IntegrityError
+from django.db.models import F
+import time
+
+# Version counters shared by every worker process, stored as Counter rows so
+# that a bump is one atomic UPDATE (the cache backend's incr() is a get and a
+# set, and two workers bumping at once could both write the same version).
+# Anything cached in-process is keyed by one of these versions, so bumping a
+# counter invalidates that data in all workers at once.
+CUSTOM_FIELD_VERSION = 'kipventory.custom_field_version'
+SEARCH_VERSION       = 'kipventory.search_version'
+# Anything shown by the item, tag and custom field endpoints (used for ETags)
+INVENTORY_VERSION    = 'kipventory.inventory_version'
+
+# Cached loan aging report, expires after settings.LOAN_AGING_CACHE_SECONDS
+LOAN_AGING = 'kipventory.loan_aging'
+
+def cart_version_key(user_pk):
+    return 'kipventory.cart_version.{}'.format(user_pk)
+
+
+def get_version(key, request=None):
+    # Remember the version on the request so that building many serializers
+    # during one request only reads the counter once.
+    if request is not None:
+        versions = getattr(request, '_cache_versions', None)
+        if versions is None:
+            versions = {}
+            request._cache_versions = versions
+        if key in versions:
+            return versions[key]
+
+    from .models import Counter
+    version = Counter.objects.filter(name=key).values_list('value', flat=True).first()
+    if version is None:
+        version = create_version(key)
+
+    if request is not None:
+        versions[key] = version
+    return version
+
+def create_version(key):
+    # Seed from the clock so a counter that was lost (e.g. a restored database)
+    # can never hand out a version number that a worker has already cached
+    # stale data under.
+    from .models import Counter
+    try:
+        with transaction.atomic():
+            Counter.objects.create(name=key, value=int(time.time() * 1000))
+    except IntegrityError:
+        pass
+    return Counter.objects.get(name=key).value
+
+def bump_version(key):
+    # Wait for the surrounding transaction (if any) to commit, otherwise another
+    # worker could rebuild from the old rows and cache them under the new version.
+    # A key only needs bumping once per transaction, however many rows changed.
+    connection = transaction.get_connection()
+    if connection.in_atomic_block:
+        for sids, func in connection.run_on_commit:
+            if getattr(func, 'version_key', None) == key:
+                return
+
+    def bump():
+        from .models import Counter
+        if not Counter.objects.filter(name=key).update(value=F('value') + 1):
+            create_version(key)
+            Counter.objects.filter(name=key).update(value=F('value') + 1)
+    bump.version_key = key
+    transaction.on_commit(bump)
@@ -4,7 +4,6 @@ from django.core.mail import EmailMultiAlternatives
 from datetime import datetime
 from django.utils import timezone
 from django.conf import settings
-from django.db.models import F
 
 
 DOMAIN = "https://colab-sbx-277.oit.duke.edu/"
@@ -75,7 +74,7 @@ class SendLoanReminderEmail(CronJobBase):
         print(loan_reminders_to_send)
 
         # Determine which users have recorded loans (exclude returned loans)
-        recorded_loans = models.Loan.objects.filter(quantity_loaned__gt=F('quantity_returned'))
+        recorded_loans = models.Loan.objects.filter(outstanding=True)
         loan_reminder_contents = {}
         for loan in recorded_loans:
             user = models.User.objects.get(username=loan.request.requester)
@@ -0,0 +1,119 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Sum
+from django.utils.crypto import get_random_string
+from api import models, stock
+import queue, random, threading, time
+
+
+class Command(BaseCommand):
+    help = ("Approve many requests for the same stock from concurrent threads and check that nothing "
+            "was oversold. Creates its own users, item and requests, and deletes them afterwards. "
+            "Run it against Postgres; SQLite only allows one writer at a time.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help="Number of concurrent approvers.")
+        parser.add_argument('--requests', type=int, default=60, help="Number of outstanding requests.")
+        parser.add_argument('--stock', type=int, default=100, help="Quantity in stock.")
+        parser.add_argument('--quantity', type=int, default=3, help="Quantity asked for by each request.")
+        parser.add_argument('--assets', action='store_true',
+                            help="Use an asset tracked item, with requests asking for overlapping assets.")
+        parser.add_argument('--keep', action='store_true', help="Don't delete the benchmark data.")
+
+    def handle(self, *args, **options):
+        n_threads, n_requests = options['threads'], options['requests']
+        in_stock, quantity = options['stock'], options['quantity']
+        if connection.vendor == 'sqlite':
+            self.stderr.write("Warning: SQLite serializes writers, so this doesn't test row locking.")
+
+        suffix = get_random_string(8)
+        administrator = User.objects.create_user('benchmark-admin-' + suffix, is_staff=True)
+        requester = User.objects.create_user('benchmark-user-' + suffix)
+        item = models.Item.objects.create(name='benchmark-item-' + suffix, quantity=in_stock, has_assets=options['assets'])
+        assets = list(item.assets.all())
+
+        work = queue.Queue()
+        for i in range(n_requests):
+            request = models.Request.objects.create(requester=requester, open_comment='benchmark')
+            models.RequestedItem.objects.create(request=request, item=item, quantity=quantity, request_type=models.LOAN)
+            work.put((request, random.sample(assets, quantity) if assets else []))
+
+        results = {"approved": 0, "rejected": 0, "failed": [], "latencies": []}
+        results_lock = threading.Lock()
+
+        def approve():
+            try:
+                while True:
+                    try:
+                        request, request_assets = work.get_nowait()
+                    except queue.Empty:
+                        return
+                    approved_item = {"item": item, "quantity": quantity, "request_type": models.LOAN, "assets": request_assets}
+                    started = time.time()
+                    try:
+                        stock.approve_requests([{"request": request, "approved_items": [approved_item]}], administrator)
+                        outcome = "approved"
+                    except stock.ApprovalError:
+                        outcome = "rejected"
+                    except Exception as e:
+                        outcome = e
+                    with results_lock:
+                        results["latencies"].append(time.time() - started)
+                        if isinstance(outcome, Exception):
+                            results["failed"].append(outcome)
+                        else:
+                            results[outcome] += 1
+            finally:
+                # every thread gets its own connection
+                connection.close()
+
+        threads = [threading.Thread(target=approve) for i in range(n_threads)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        try:
+            item.refresh_from_db()
+            loaned = models.Loan.objects.filter(item=item).aggregate(total=Sum('quantity_loaned'))['total'] or 0
+            approved = models.Request.objects.filter(requester=requester, status=models.APPROVED).count()
+            latencies = sorted(results["latencies"])
+
+            self.stdout.write("{} requests for {} each against a stock of {}, {} threads: {:.2f}s".format(
+                n_requests, quantity, in_stock, n_threads, elapsed))
+            self.stdout.write("approved {}, rejected {}, failed {}".format(results["approved"], results["rejected"], len(results["failed"])))
+            if latencies:
+                self.stdout.write("latency median {:.1f}ms, max {:.1f}ms".format(
+                    latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+            for error in results["failed"][:5]:
+                self.stderr.write("  {!r}".format(error))
+
+            problems = []
+            if results["failed"]:
+                problems.append("{} approval(s) failed with an error".format(len(results["failed"])))
+            if item.quantity < 0 or loaned > in_stock:
+                problems.append("oversold: {} loaned out of {}".format(loaned, in_stock))
+            if item.quantity != in_stock - loaned:
+                problems.append("item quantity is {}, expected {}".format(item.quantity, in_stock - loaned))
+            if approved * quantity != loaned:
+                problems.append("{} approved requests but {} loaned".format(approved, loaned))
+            if options['assets']:
+                double_loaned = models.Loan.objects.filter(item=item).order_by().values('asset_id').annotate(n=Sum('quantity_loaned')).filter(n__gt=1)
+                if double_loaned.exists():
+                    problems.append("{} asset(s) loaned more than once".format(double_loaned.count()))
+                if item.assets_loaned != loaned:
+                    problems.append("item counts {} loaned assets, expected {}".format(item.assets_loaned, loaned))
+            if not assets and results["approved"] != min(n_requests, in_stock // quantity):
+                problems.append("approved {}, expected {}".format(results["approved"], min(n_requests, in_stock // quantity)))
+        finally:
+            if not options['keep']:
+                item.delete()
+                requester.delete()
+                administrator.delete()
+
+        if problems:
+            raise CommandError("; ".join(problems))
+        self.stdout.write("No oversell.")
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from api import models, caches
+
+
+class Command(BaseCommand):
+    help = "Recompute every item's asset status counters from the Asset rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report the items whose counters are wrong.")
+
+    def handle(self, *args, **options):
+        fields = list(models.ASSET_COUNT_FIELDS.items())
+        fixed = 0
+        with transaction.atomic():
+            # Lock the counters before counting. Asset changes update the counters
+            # in the same transaction, so any that haven't committed by now wait
+            # for us and then apply their change on top of the reconciled value.
+            items = list(models.Item.objects.select_for_update().order_by('pk')
+                                            .values_list('pk', 'name', *[field for status, field in fields]))
+            actual = {}
+            for item_pk, status, count in models.Asset.objects.values_list('item_id', 'status').annotate(count=Count('id')).order_by():
+                actual.setdefault(item_pk, {})[status] = count
+
+            for row in items:
+                item_pk, name, stored = row[0], row[1], row[2:]
+                counts = actual.get(item_pk, {})
+                expected = [counts.get(status, 0) for status, field in fields]
+                if list(stored) == expected:
+                    continue
+                fixed += 1
+                self.stdout.write("{}: {} -> {}".format(name, list(stored), expected))
+                if not options['dry_run']:
+                    models.Item.objects.filter(pk=item_pk).update(**{field: value for (status, field), value in zip(fields, expected)})
+
+        if fixed and not options['dry_run']:
+            caches.bump_version(caches.INVENTORY_VERSION)
+        self.stdout.write("{} item(s) {}.".format(fixed, "out of date" if options['dry_run'] else "reconciled"))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 02:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_search_text(apps, schema_editor):
+    Item = apps.get_model('api', 'Item')
+    CustomValue = apps.get_model('api', 'CustomValue')
+    documents = {}
+    for pk, name, model_no, description in Item.objects.values_list('pk', 'name', 'model_no', 'description'):
+        documents[pk] = [name, model_no, description]
+    values = CustomValue.objects.filter(field__private=False, field__field_type__in=('Single', 'Multi')) \
+                                .order_by('field__name') \
+                                .values_list('item_id', 'field__field_type', 'Single', 'Multi')
+    for item_id, field_type, single, multi in values:
+        documents[item_id].append(single if field_type == 'Single' else multi)
+    for pk, parts in documents.items():
+        Item.objects.filter(pk=pk).update(search_text="\n".join(part for part in parts if part))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(populate_search_text, migrations.RunPython.noop),
+    ]
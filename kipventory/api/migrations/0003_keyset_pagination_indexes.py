@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 02:18
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_item_search_text'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='log',
+            index_together=set([('date_created', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='request',
+            index_together=set([('date_open', 'id')]),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 02:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_assets(apps, schema_editor):
+    Item = apps.get_model('api', 'Item')
+    Asset = apps.get_model('api', 'Asset')
+    fields = {'In Stock': 'assets_in_stock', 'Loaned': 'assets_loaned', 'Disbursed': 'assets_disbursed', 'Lost': 'assets_lost'}
+    for item_pk, status, count in Asset.objects.values_list('item_id', 'status').annotate(count=Count('id')).order_by():
+        if status in fields:
+            Item.objects.filter(pk=item_pk).update(**{fields[status]: count})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='assets_disbursed',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='assets_in_stock',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='assets_loaned',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='assets_lost',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_assets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+DEFAULTS = {'Single': '', 'Multi': '', 'Int': 0, 'Float': 0.0}
+
+def drop_default_values(apps, schema_editor):
+    # Sparse mode doesn't store values that are equal to their field's default
+    if not getattr(settings, 'SPARSE_CUSTOM_VALUES', False):
+        return
+    for model_name in ('CustomValue', 'CustomAssetValue'):
+        model = apps.get_model('api', model_name)
+        for field_type, default in DEFAULTS.items():
+            model.objects.filter(field__field_type=field_type, **{field_type: default}).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_asset_tag_counter'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_default_values, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 02:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from collections import defaultdict
+import json
+
+
+def pack_values(apps, schema_editor):
+    for owner_name, value_name, owner in (('Item', 'CustomValue', 'item'), ('Asset', 'CustomAssetValue', 'asset')):
+        Owner = apps.get_model('api', owner_name)
+        Value = apps.get_model('api', value_name)
+        documents = defaultdict(dict)
+        rows = Value.objects.values_list(owner + '_id', 'field__name', 'field__field_type', 'Single', 'Multi', 'Int', 'Float')
+        for pk, field_name, field_type, single, multi, int_val, float_val in rows:
+            documents[pk][field_name] = {'Single': single, 'Multi': multi, 'Int': int_val, 'Float': float_val}[field_type]
+        for pk, doc in documents.items():
+            Owner.objects.filter(pk=pk).update(packed_values=json.dumps(doc, sort_keys=True))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_sparse_custom_values'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asset',
+            name='packed_values',
+            field=models.TextField(default='{}', editable=False),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='packed_values',
+            field=models.TextField(default='{}', editable=False),
+        ),
+        migrations.RunPython(pack_values, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 02:30
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_packed_custom_values'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='customvalue',
+            index_together=set([('field', 'Float'), ('field', 'Int'), ('field', 'Single')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 02:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_returned_loans(apps, schema_editor):
+    Loan = apps.get_model('api', 'Loan')
+    Loan.objects.filter(quantity_loaned__lte=F('quantity_returned')).update(outstanding=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_custom_value_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loan',
+            name='outstanding',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.RunPython(mark_returned_loans, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='loan',
+            index_together=set([('request', 'outstanding'), ('item', 'outstanding')]),
+        ),
+    ]
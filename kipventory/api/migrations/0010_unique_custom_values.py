@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 02:55
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count
+from collections import defaultdict
+import json
+
+DEFAULTS = {'Single': '', 'Multi': '', 'Int': 0, 'Float': 0.0}
+
+
+def remove_duplicate_values(apps, schema_editor):
+    # Keep one row per field and owner: one that holds a value if there is one,
+    # else the oldest. Then repack the documents of the owners that had duplicates.
+    for owner_name, value_name, owner in (('Item', 'CustomValue', 'item'), ('Asset', 'CustomAssetValue', 'asset')):
+        Owner = apps.get_model('api', owner_name)
+        Value = apps.get_model('api', value_name)
+        duplicated = Value.objects.values('field_id', owner + '_id').annotate(n=Count('id')).order_by().filter(n__gt=1)
+        repack = set()
+        for group in duplicated:
+            rows = list(Value.objects.filter(field_id=group['field_id'], **{owner + '_id': group[owner + '_id']})
+                                     .select_related('field').order_by('pk'))
+            field_type = rows[0].field.field_type
+            keep = next((row for row in rows if getattr(row, field_type) != DEFAULTS[field_type]), rows[0])
+            Value.objects.filter(pk__in=[row.pk for row in rows if row.pk != keep.pk]).delete()
+            repack.add(group[owner + '_id'])
+
+        documents = defaultdict(dict)
+        rows = Value.objects.filter(**{owner + '_id__in': repack}) \
+                            .values_list(owner + '_id', 'field__name', 'field__field_type', 'Single', 'Multi', 'Int', 'Float')
+        for pk, field_name, field_type, single, multi, int_val, float_val in rows:
+            documents[pk][field_name] = {'Single': single, 'Multi': multi, 'Int': int_val, 'Float': float_val}[field_type]
+        for pk in repack:
+            Owner.objects.filter(pk=pk).update(packed_values=json.dumps(documents[pk], sort_keys=True))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_loan_outstanding'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_values, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='customassetvalue',
+            unique_together=set([('field', 'asset')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='customvalue',
+            unique_together=set([('field', 'item')]),
+        ),
+    ]
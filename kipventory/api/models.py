@@ -1,11 +1,14 @@
-from django.db import models
+from django.db import models, transaction, connection, IntegrityError
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.conf import settings
 import copy
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 from .validators import validate_file_extension
+from . import caches
 import uuid
+import json
 
 LOAN = 'loan'
 DISBURSEMENT = 'disbursement'
@@ -42,6 +45,14 @@ FIELD_TYPE_DICT = {
     'Float': float
 }
 
+def default_value(field_type):
+    return FIELD_TYPE_DICT[field_type]()
+
+# In sparse mode only custom values that differ from their field's default
+# are stored, and readers fill in the defaults for any missing rows.
+def sparse_custom_values():
+    return getattr(settings, 'SPARSE_CUSTOM_VALUES', False)
+
 ACQUISITION      = 'Acquisition'
 LOSS             = 'Loss'
 CATEGORY_CHOICES = (
@@ -93,6 +104,21 @@ class Item(models.Model):
     description = models.TextField(default='', blank=True)
     tags        = models.ManyToManyField(Tag, blank=True)
     has_assets  = models.BooleanField(default=False)
+    # Denormalized for searching, see api/search.py
+    search_text = models.TextField(default='', blank=True, editable=False)
+    # JSON object of this item's stored custom values, see refresh_packed_values()
+    packed_values = models.TextField(default='{}', editable=False)
+    # Number of this item's assets with each status, kept up to date by Asset
+    # (see ASSET_COUNT_FIELDS). `manage.py reconcile_asset_counts` recomputes them.
+    assets_in_stock  = models.IntegerField(default=0, editable=False)
+    assets_loaned    = models.IntegerField(default=0, editable=False)
+    assets_disbursed = models.IntegerField(default=0, editable=False)
+    assets_lost      = models.IntegerField(default=0, editable=False)
+
+    # Columns that are maintained with `update()` elsewhere. A regular `save()`
+    # leaves them alone so a stale instance can't overwrite them.
+    DENORMALIZED_FIELDS = ('search_text', 'packed_values', 'assets_in_stock', 'assets_loaned', 'assets_disbursed', 'assets_lost')
+    SEARCH_FIELDS = ('name', 'model_no', 'description')
 
     class Meta:
         ordering = ('name',)
@@ -100,6 +126,16 @@ class Item(models.Model):
     def __str__(self):
         return "{}".format(self.name)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Item, cls).from_db(db, field_names, values)
+        instance._search_snapshot = instance.get_search_snapshot()
+        instance._quantity_snapshot = instance.quantity
+        return instance
+
+    def get_search_snapshot(self):
+        return tuple(self.__dict__.get(field) for field in self.SEARCH_FIELDS)
+
     def save(self, *args, **kwargs):
         # If this instance is in the database already, then it will have a
         # Primary Key value.
@@ -109,35 +145,107 @@ class Item(models.Model):
         if not self.pk:
             is_creation = True
 
+        if not is_creation and kwargs.get('update_fields') is None:
+            skipped = self.get_deferred_fields()
+            # Stock is moved with F() updates (see stock.py), so only write the
+            # quantity when it was changed on this instance
+            if self.quantity == getattr(self, '_quantity_snapshot', None):
+                skipped.add('quantity')
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.DENORMALIZED_FIELDS and f.attname not in skipped]
+
         super(Item, self).save(*args, **kwargs)
+        self._quantity_snapshot = self.quantity
 
         # If this call to `save` is creating a new Item, then we must also create
-        # a CustomValue for each CustomField that currently exists.
+        # a CustomValue for each CustomField that currently exists (unless they're sparse).
         # Note that this block won't run if we're simply updating this Item via
         # the `save` method. This should strictly run upon creation.
         if is_creation:
             # create an empty CustomValue associated with this Item for each CustomField
-            for cf in CustomField.objects.all():
-                cv = CustomValue(field=cf, item=self)
-                cv.save()
+            if not sparse_custom_values():
+                for cf in CustomField.objects.all():
+                    cv = CustomValue(field=cf, item=self)
+                    cv.save()
             if self.has_assets:
-                for i in range(self.quantity):
-                    asset = Asset.objects.create(item=self)
+                create_assets(self, self.quantity)
+
+        if is_creation or self.get_search_snapshot() != getattr(self, '_search_snapshot', None):
+            from . import search
+            search.refresh_search_text([self.pk])
+            self._search_snapshot = self.get_search_snapshot()
 
 def uuid_to_str():
     return str(uuid.uuid4())
 
+class Counter(models.Model):
+    name  = models.TextField(unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return "{}: {}".format(self.name, self.value)
+
+ASSET_TAG_COUNTER = 'asset_tag'
+
+def allocate_asset_tags(n):
+    # Reserve `n` consecutive asset tags and return them as a range. The counter
+    # row stays locked until the surrounding transaction ends, so concurrent
+    # callers always get separate blocks.
+    if n <= 0:
+        return range(0)
+    while True:
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("UPDATE {} SET value = value + %s WHERE name = %s RETURNING value".format(Counter._meta.db_table),
+                               [n, ASSET_TAG_COUNTER])
+                row = cursor.fetchone()
+            value = row[0] if row else None
+        else:
+            with transaction.atomic():
+                updated = Counter.objects.filter(name=ASSET_TAG_COUNTER).update(value=models.F('value') + n)
+                value = Counter.objects.get(name=ASSET_TAG_COUNTER).value if updated else None
+        if value is not None:
+            return range(value - n + 1, value + 1)
+
+        # First allocation - start after the highest tag in use
+        highest = Asset.objects.aggregate(highest=models.Max('tag'))['highest'] or 0
+        try:
+            with transaction.atomic():
+                Counter.objects.create(name=ASSET_TAG_COUNTER, value=highest)
+        except IntegrityError:
+            pass
+
+def reserve_asset_tag(tag):
+    # Make sure a tag that was picked by hand is never handed out again
+    Counter.objects.filter(name=ASSET_TAG_COUNTER, value__lt=tag).update(value=tag)
+
+# Default for Asset.tag (migration 0001 refers to it by name)
 def auto_incr_asset():
-    asset = Asset.objects.all().order_by('-tag').first()
-    if (asset is None):
-        return 1
-    return asset.tag + 1
+    return allocate_asset_tags(1)[0]
+
 
+# The Item counter for each asset status
+ASSET_COUNT_FIELDS = {
+    IN_STOCK: 'assets_in_stock',
+    LOANED: 'assets_loaned',
+    DISBURSED: 'assets_disbursed',
+    LOST: 'assets_lost',
+}
+
+def update_asset_counts(item_pk, status, delta):
+    field = ASSET_COUNT_FIELDS.get(status)
+    if field is not None and delta:
+        Item.objects.filter(pk=item_pk).update(**{field: models.F(field) + delta})
 
 class Asset(models.Model):
     tag = models.IntegerField(unique=True, default=auto_incr_asset)
     item = models.ForeignKey('Item', on_delete=models.CASCADE, related_name="assets")
     status = models.TextField(choices=ASSET_STATUS_TYPES, default=IN_STOCK)
+    # JSON object of this asset's stored custom values, see refresh_packed_values()
+    packed_values = models.TextField(default='{}', editable=False)
+
+    # Like Item.DENORMALIZED_FIELDS
+    DENORMALIZED_FIELDS = ('packed_values',)
 
     class Meta:
         ordering = ('tag',)
@@ -145,18 +253,72 @@ class Asset(models.Model):
     def __str__(self):
         return "{}: {}".format(self.item.name, self.pk)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Asset, cls).from_db(db, field_names, values)
+        instance._counted_as = (instance.__dict__.get('item_id'), instance.__dict__.get('status'))
+        instance._loaded_tag = instance.__dict__.get('tag')
+        return instance
+
     def save(self, *args, **kwargs):
         is_creation = False
         if not self.pk:
             is_creation = True
-        super().save(*args, **kwargs)
 
-        if is_creation:
+        if not is_creation and kwargs.get('update_fields') is None:
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.DENORMALIZED_FIELDS and f.attname not in deferred]
+
+        # The item's status counters have to change along with the asset
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            counted_as = (None, None) if is_creation else getattr(self, '_counted_as', (None, None))
+            if counted_as != (self.item_id, self.status):
+                if counted_as[0] is not None:
+                    update_asset_counts(counted_as[0], counted_as[1], -1)
+                update_asset_counts(self.item_id, self.status, 1)
+                self._counted_as = (self.item_id, self.status)
+            if not is_creation and self.tag != getattr(self, '_loaded_tag', self.tag):
+                reserve_asset_tag(self.tag)
+                self._loaded_tag = self.tag
+
+        if is_creation and not sparse_custom_values():
             # create an empty CustomAssetValue associated with this Item for each CustomField
             for cf in CustomField.objects.filter(asset_tracked=True):
                 cv = CustomAssetValue(field=cf, asset=self)
                 cv.save()
 
+    # Deleting through a QuerySet (or a cascade from the Item) skips this, so
+    # code doing that for a surviving Item has to fix its counters itself.
+    def delete(self, *args, **kwargs):
+        counted_as = getattr(self, '_counted_as', (self.item_id, self.status))
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            update_asset_counts(counted_as[0], counted_as[1], -1)
+        return result
+
+def create_assets(item, n):
+    # Create `n` in-stock assets of `item` along with their custom asset values
+    # in a handful of queries, and return them. This skips Asset.save(), so the
+    # item's counters and the inventory version are updated here instead.
+    if n <= 0:
+        return []
+    with transaction.atomic():
+        tags = allocate_asset_tags(n)
+        Asset.objects.bulk_create([Asset(item=item, tag=tag, status=IN_STOCK) for tag in tags])
+        # the tags are a block reserved for us, so this finds exactly the new assets
+        assets = list(Asset.objects.filter(tag__gte=tags[0], tag__lte=tags[-1]))
+
+        if not sparse_custom_values():
+            field_names = list(CustomField.objects.filter(asset_tracked=True).values_list('name', flat=True))
+            CustomAssetValue.objects.bulk_create([CustomAssetValue(field_id=field_name, asset=asset)
+                                                  for asset in assets for field_name in field_names])
+
+        update_asset_counts(item.pk, IN_STOCK, len(assets))
+        caches.bump_version(caches.INVENTORY_VERSION)
+    return assets
+
 class CartItem(models.Model):
     owner        = models.ForeignKey(User, on_delete=models.CASCADE, related_name='cart_items')
     item         = models.ForeignKey(Item, on_delete=models.CASCADE)
@@ -175,30 +337,143 @@ class CustomField(models.Model):
     class Meta:
         ordering = ('name',)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(CustomField, cls).from_db(db, field_names, values)
+        instance._search_snapshot = (instance.__dict__.get('private'), instance.__dict__.get('field_type'))
+        return instance
+
     def save(self, *args, **kwargs):
         # Determine if this `save()` call is for creation or modification
         is_creation = False
         if not self.pk:
             is_creation = True
         super(CustomField, self).save(*args, **kwargs)
-        if is_creation:
-            # create a null value for each item that currently exists
-            for item in Item.objects.all():
-                satisfied_fields = set( val.field.name for val in item.values.all() )
-                if self.name not in satisfied_fields:
-                    cv = CustomValue(field=self, item=item)
-                    cv.save()
-
-            if self.asset_tracked:
-                for asset in Asset.objects.all():
-                    satisfied_fields = set( val.field.name for val in asset.values.all() )
-                    if self.name not in satisfied_fields:
-                        cv = CustomAssetValue(field=self, asset=asset)
-                        cv.save()
+        if not is_creation and (self.private, self.field_type) != getattr(self, '_search_snapshot', None):
+            # the field may have been hidden from or exposed to search
+            from . import search
+            search.refresh_search_text(self.item_values.values_list('item_id', flat=True))
+            self._search_snapshot = (self.private, self.field_type)
+        if is_creation and not sparse_custom_values():
+            # create a default value for each item (and asset) that currently exists
+            if getattr(settings, 'CUSTOM_FIELD_BACKFILL_ASYNC', False):
+                from . import tasks
+                name = self.name
+                transaction.on_commit(lambda: tasks.backfill_custom_values.delay(name))
+            else:
+                backfill_custom_values(self)
 
     def __str__(self):
         return "{}".format(self.name)
 
+# Serializers cache the DRF fields built from the CustomFields, keyed by this version.
+@receiver(post_save, sender=CustomField)
+@receiver(post_delete, sender=CustomField)
+def bump_custom_field_version(sender, **kwargs):
+    caches.bump_version(caches.CUSTOM_FIELD_VERSION)
+
+# Deleting a text field drops its values, so those items need their search text rebuilt.
+@receiver(pre_delete, sender=CustomField)
+def collect_searchable_items(sender, instance, **kwargs):
+    instance._searchable_item_pks = []
+    if not instance.private and instance.field_type in ('Single', 'Multi'):
+        instance._searchable_item_pks = list(instance.item_values.exclude(**{instance.field_type: ''})
+                                                                .values_list('item_id', flat=True))
+
+@receiver(post_delete, sender=CustomField)
+def refresh_searchable_items(sender, instance, **kwargs):
+    pks = getattr(instance, '_searchable_item_pks', None)
+    if pks:
+        from . import search
+        search.refresh_search_text(pks)
+
+# Drop the deleted field from the packed documents, or a new field with the same
+# name would pick its values up. The match is textual, so it may refresh a few
+# documents that merely contain the name in a value.
+@receiver(post_delete, sender=CustomField)
+def refresh_packed_documents(sender, instance, **kwargs):
+    key = json.dumps(instance.name) + ':'
+    for model in (Item, Asset):
+        pks = model.objects.filter(packed_values__contains=key).values_list('pk', flat=True)
+        refresh_packed_values(model, pks)
+
+BACKFILL_CHUNK_SIZE = 2000
+
+def backfill_custom_values(field):
+    # Give every item (and every asset, for asset tracked fields) that doesn't
+    # have a value for `field` yet a default one. Works through the rows in
+    # chunks found with an anti-join, each committed on its own, so it is safe
+    # to run again if it gets interrupted.
+    def backfill(owners, make_value, model, owner):
+        last_pk = 0
+        while True:
+            pks = list(owners.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:BACKFILL_CHUNK_SIZE])
+            if not pks:
+                return
+            while True:
+                try:
+                    with transaction.atomic():
+                        # set_custom_value() may have written some of these since the anti-join
+                        existing = set(model.objects.filter(field=field, **{owner + '__pk__in': pks}).values_list(owner + '_id', flat=True))
+                        model.objects.bulk_create([make_value(pk) for pk in pks if pk not in existing])
+                    break
+                except IntegrityError:
+                    # ... or just now (the rows are unique per field and owner), so look again
+                    continue
+            last_pk = pks[-1]
+
+    backfill(Item.objects.exclude(values__field=field),
+             lambda pk: CustomValue(field=field, item_id=pk), CustomValue, 'item')
+    if field.asset_tracked:
+        backfill(Asset.objects.exclude(values__field=field),
+                 lambda pk: CustomAssetValue(field=field, asset_id=pk), CustomAssetValue, 'asset')
+    caches.bump_version(caches.INVENTORY_VERSION)
+
+def set_custom_value(values, field, value):
+    # `values` is the `values` manager of an Item or Asset. In sparse mode a
+    # value that is set back to the field's default deletes its row instead.
+    # Returns True if an Item's search text has to be refreshed, which callers
+    # do once per item after writing all its values (search.refresh_search_text()).
+    searchable = values.model is CustomValue and not field.private and field.field_type in ('Single', 'Multi')
+    if sparse_custom_values() and value == default_value(field.field_type):
+        deleted = False
+        for cv in values.filter(field=field):
+            cv.delete()
+            deleted = True
+        if deleted and values.model is CustomValue:
+            caches.bump_version(caches.INVENTORY_VERSION)
+        return deleted and searchable
+    cv, _ = values.get_or_create(field=field)
+    changed = getattr(cv, field.field_type) != value
+    setattr(cv, field.field_type, value)
+    cv.save()
+    return changed and searchable
+
+def refresh_packed_values(model, pks):
+    # Rebuild the `packed_values` document of the given Items or Assets from
+    # their value rows, so that reads don't need to join them. Anything that
+    # writes custom values has to call this afterwards. Returns {pk: document}.
+    value_model, owner = (CustomValue, 'item') if model is Item else (CustomAssetValue, 'asset')
+    pks = list(set(pks))
+    if not pks:
+        return {}
+    documents = {}
+    with transaction.atomic():
+        for start in range(0, len(pks), 500):
+            chunk = pks[start:start + 500]
+            values = {pk: {} for pk in chunk}
+            rows = value_model.objects.filter(**{owner + '__pk__in': chunk}) \
+                                      .values_list(owner + '_id', 'field__name', 'field__field_type',
+                                                   'Single', 'Multi', 'Int', 'Float')
+            for pk, field_name, field_type, single, multi, int_val, float_val in rows:
+                values[pk][field_name] = {'Single': single, 'Multi': multi, 'Int': int_val, 'Float': float_val}[field_type]
+            for pk, doc in values.items():
+                documents[pk] = json.dumps(doc, sort_keys=True)
+                model.objects.filter(pk=pk).update(packed_values=documents[pk])
+    if model is Item:
+        caches.bump_version(caches.INVENTORY_VERSION)
+    return documents
+
 class CustomValue(models.Model):
     field  = models.ForeignKey(CustomField, on_delete=models.CASCADE, related_name="item_values", to_field="name")
     item   = models.ForeignKey(Item, on_delete=models.CASCADE, related_name="values")
@@ -209,6 +484,15 @@ class CustomValue(models.Model):
 
     class Meta:
         ordering = ('field__name',)
+        # one value per field and item; the backfill and set_custom_value() rely on it
+        unique_together = ('field', 'item')
+        # for filtering and sorting items by custom field (see search.py). Text
+        # values can exceed the Postgres btree row size limit, so they aren't
+        # indexed and are filtered through the field_id index alone.
+        index_together = (('field', 'Int'), ('field', 'Float'))
+
+    # Text values are part of the Item's search text, which isn't refreshed on
+    # every save; see set_custom_value().
 
     def get_value(self):
         return getattr(self, self.field.field_type)
@@ -226,6 +510,7 @@ class CustomAssetValue(models.Model):
 
     class Meta:
         ordering = ('field__name',)
+        unique_together = ('field', 'asset')
 
     def get_value(self):
         return getattr(self, self.field.field_type)
@@ -244,6 +529,8 @@ class Request(models.Model):
 
     class Meta:
         ordering = ('-date_open',)
+        # keyset (cursor) pagination walks the list in this order
+        index_together = (('date_open', 'id'),)
 
 class RequestedItem(models.Model):
     request      = models.ForeignKey(Request, on_delete=models.CASCADE, related_name='requested_items', blank=True, null=True)
@@ -264,42 +551,6 @@ class ApprovedItem(models.Model):
     class Meta:
         ordering = ('item__name',)
 
-    def save(self, *args, **kwargs):
-        is_creation = False
-        if not self.pk:
-            is_creation = True
-        assets = kwargs.pop('assets', [])
-        super().save(*args, **kwargs)
-        for asset in assets:
-            self.assets.add(asset)
-
-        if is_creation:
-            self.createLoansAndDisbursements()
-
-    def createLoansAndDisbursements(self):
-        if (self.assets.all().count() > 0):
-            for asset in self.assets.all():
-                if self.request_type == DISBURSEMENT:
-                    disbursement = Disbursement.objects.create(request=self.request, item=self.item, asset=asset, quantity=1)
-                    asset.status = DISBURSED
-                elif self.request_type == LOAN:
-                    loan = Loan.objects.create(request=self.request, item=self.item, asset=asset, quantity_loaned=1)
-                    asset.status = LOANED
-
-                asset.save()
-                self.item.quantity -= 1
-                self.item.save()
-
-        else:
-            if self.request_type == DISBURSEMENT:
-                disbursement = Disbursement.objects.create(request=self.request, item=self.item, quantity=self.quantity)
-            elif self.request_type == LOAN:
-                loan = Loan.objects.create(request=self.request, item=self.item, quantity_loaned=self.quantity)
-            self.item.quantity -= self.quantity
-            self.item.save()
-
-
-
 
 class Loan(models.Model):
     request            = models.ForeignKey(Request, on_delete=models.CASCADE, related_name='loans', blank=True, null=True)
@@ -309,13 +560,22 @@ class Loan(models.Model):
     date_returned      = models.DateTimeField(blank=True, null=True)
     quantity_loaned    = models.PositiveIntegerField(default=0)
     quantity_returned  = models.PositiveIntegerField(default=0)
+    # quantity_loaned > quantity_returned, stored so outstanding loans can be
+    # found with an index. Kept up to date by save(); anything that changes the
+    # quantities with update() has to set it too.
+    outstanding        = models.BooleanField(default=True, editable=False)
     class Meta:
         ordering = ('id',)
+        index_together = (('item', 'outstanding'), ('request', 'outstanding'))
 
     def save(self, *args, **kwargs):
         is_creation = False
         if not self.pk:
             is_creation = True
+        self.outstanding = self.quantity_loaned > self.quantity_returned
+        update_fields = kwargs.get('update_fields', None)
+        if update_fields is not None and ('quantity_loaned' in update_fields or 'quantity_returned' in update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'outstanding'}
         super().save(*args, **kwargs)
         if is_creation:
             if self.asset:
@@ -419,6 +679,8 @@ class Log(models.Model):
 
     class Meta:
         ordering = ('-date_created',)
+        # keyset (cursor) pagination walks the list in this order
+        index_together = (('date_created', 'id'),)
 
     def __str__(self):
         return "{} {}".format(self.date_created, self.item, self.quantity, self.initiating_user, self.affected_user)
@@ -492,3 +754,27 @@ class Backfill(models.Model):
     requester_comment = models.TextField()
     receipt = models.FileField(upload_to="backfill/", blank=True, null=True)
     admin_comment = models.TextField(default='', max_length=1024, blank=True)
+
+# Conditional GETs on the inventory endpoints are keyed by these versions, so
+# anything those endpoints show has to bump them when it changes. Code that
+# writes with `update()` or `bulk_create()` bypasses these and must bump itself.
+# CustomValues are only ever deleted along with their Item or CustomField, or
+# by set_custom_value().
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=CustomField)
+@receiver(post_delete, sender=CustomField)
+@receiver(post_save, sender=CustomValue)
+@receiver(post_save, sender=Asset)
+@receiver(post_delete, sender=Asset)
+@receiver(m2m_changed, sender=Item.tags.through)
+def bump_inventory_version(sender, **kwargs):
+    caches.bump_version(caches.INVENTORY_VERSION)
+
+# Items show how many of them are in the user's cart
+@receiver(post_save, sender=CartItem)
+@receiver(post_delete, sender=CartItem)
+def bump_cart_version(sender, instance, **kwargs):
+    caches.bump_version(caches.cart_version_key(instance.owner_id))
@@ -0,0 +1,215 @@
+from django.db import connection, transaction
+from django.db.models import Case, When, Value, FloatField, IntegerField, ExpressionWrapper, Sum, Count, \
+                             Func, DecimalField, TextField, Max, F
+from django.db.models.functions import Coalesce
+from django.db.models.expressions import RawSQL
+from django.contrib.postgres.search import TrigramSimilarity
+from collections import defaultdict
+from . import caches, models
+import re, operator
+
+# Item search. Every Item keeps a denormalized `search_text` column holding its
+# name, model number, description and public text custom values. On Postgres it
+# is covered by a pg_trgm GIN index (see apps.py), anywhere else we fall
+# back to an inverted index built in-process.
+
+SEARCHABLE_FIELD_TYPES = ('Single', 'Multi')
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+def refresh_search_text(item_pks):
+    item_pks = list(set(item_pks))
+    with transaction.atomic():
+        for start in range(0, len(item_pks), 500):
+            chunk = item_pks[start:start + 500]
+            documents = {}
+            for pk, name, model_no, description in models.Item.objects.filter(pk__in=chunk) \
+                    .values_list('pk', 'name', 'model_no', 'description'):
+                documents[pk] = [name, model_no, description]
+
+            values = models.CustomValue.objects.filter(item__pk__in=chunk,
+                                                       field__private=False,
+                                                       field__field_type__in=SEARCHABLE_FIELD_TYPES) \
+                                               .order_by('field__name') \
+                                               .values_list('item_id', 'field__field_type', 'Single', 'Multi')
+            for item_id, field_type, single, multi in values:
+                documents[item_id].append(single if field_type == 'Single' else multi)
+
+            for pk, parts in documents.items():
+                search_text = "\n".join(part for part in parts if part)
+                models.Item.objects.filter(pk=pk).update(search_text=search_text)
+    caches.bump_version(caches.SEARCH_VERSION)
+
+def search_items(queryset, text):
+    text = text.strip()
+    if not text:
+        return queryset
+    if connection.vendor == 'postgresql':
+        return _search_trigram(queryset, text)
+    return _search_fallback(queryset, text)
+
+def _like_pattern(text):
+    return '%{}%'.format(text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+
+def _search_trigram(queryset, text):
+    # Both ILIKE and the `%` (similarity) operator can use the trigram index,
+    # which `icontains` (UPPER(...) LIKE UPPER(...)) can't.
+    where = "({0}.search_text ILIKE %s OR {0}.search_text %% %s)".format(connection.ops.quote_name(models.Item._meta.db_table))
+    queryset = queryset.extra(where=[where], params=[_like_pattern(text), text])
+
+    # Matches on the name count for more than matches anywhere else
+    name_prefix = Case(When(name__istartswith=text, then=Value(1.0)), default=Value(0.0), output_field=FloatField())
+    rank = ExpressionWrapper(TrigramSimilarity('name', text) * 2 + TrigramSimilarity('search_text', text) + name_prefix,
+                             output_field=FloatField())
+    # Rounded to a numeric so that keyset pagination can compare it exactly
+    rank = Func(rank, template='ROUND((%(expressions)s)::numeric, 6)', output_field=DecimalField(max_digits=12, decimal_places=6))
+    return queryset.annotate(search_rank=rank).order_by('-search_rank', 'name')
+
+
+_fallback_index = (None, {}, {})
+
+def _get_fallback_index():
+    global _fallback_index
+    version = caches.get_version(caches.SEARCH_VERSION)
+    if _fallback_index[0] != version:
+        postings = defaultdict(set)
+        names = {}
+        for pk, name, search_text in models.Item.objects.values_list('pk', 'name', 'search_text'):
+            names[pk] = name.lower()
+            for token in tokenize(search_text):
+                postings[token].add(pk)
+        _fallback_index = (version, dict(postings), names)
+    return _fallback_index
+
+def _search_fallback(queryset, text):
+    version, postings, names = _get_fallback_index()
+    terms = tokenize(text)
+    if not terms:
+        return queryset.filter(search_text__icontains=text).order_by('name')
+
+    # Every term has to match some token: exact matches score highest, then
+    # prefixes (search-as-you-type), then any substring.
+    scores = None
+    for term in terms:
+        term_scores = {}
+        for token, pks in postings.items():
+            if token == term:
+                score = 3
+            elif token.startswith(term):
+                score = 2
+            elif term in token:
+                score = 1
+            else:
+                continue
+            for pk in pks:
+                if score > term_scores.get(pk, 0):
+                    term_scores[pk] = score
+        if scores is None:
+            scores = term_scores
+        else:
+            scores = {pk: score + term_scores[pk] for pk, score in scores.items() if pk in term_scores}
+
+    needle = text.lower()
+    for pk in scores:
+        if names[pk].startswith(needle):
+            scores[pk] += 5
+        elif needle in names[pk]:
+            scores[pk] += 3
+
+    ranked = sorted(scores, key=lambda pk: (-scores[pk], names[pk]))
+    if not ranked:
+        return queryset.none()
+    # sqlite can only bind so many parameters, so the primary keys (integers
+    # from our own index) go into the SQL as literals and every match is kept
+    column = "{}.{}".format(connection.ops.quote_name(models.Item._meta.db_table), connection.ops.quote_name('id'))
+    pks = ", ".join(str(int(pk)) for pk in ranked)
+    position = RawSQL("CASE {} {} END".format(column, " ".join("WHEN {} THEN {}".format(int(pk), i) for i, pk in enumerate(ranked))),
+                      [], output_field=IntegerField())
+    return queryset.extra(where=["{} IN ({})".format(column, pks)]).annotate(search_position=position).order_by('search_position')
+
+
+def filter_by_tags(queryset, include_tags, exclude_tags):
+    # Resolve the whole include/exclude expression with one grouped query over
+    # the Item-Tag through table instead of a join per tag.
+    include_tags = set(include_tags)
+    exclude_tags = set(exclude_tags)
+    through = models.Item.tags.through
+
+    if include_tags:
+        def count_tags(tags):
+            return Sum(Case(When(tag__name__in=tags, then=Value(1)), default=Value(0), output_field=IntegerField()))
+
+        matches = through.objects.filter(tag__name__in=include_tags | exclude_tags).values('item_id')
+        if exclude_tags:
+            matches = matches.annotate(included=count_tags(include_tags), excluded=count_tags(exclude_tags)) \
+                             .filter(included=len(include_tags), excluded=0)
+        else:
+            matches = matches.annotate(included=count_tags(include_tags)).filter(included=len(include_tags))
+        return queryset.filter(pk__in=matches.values('item_id'))
+
+    if exclude_tags:
+        return queryset.exclude(pk__in=through.objects.filter(tag__name__in=exclude_tags).values('item_id'))
+
+    return queryset
+
+def tag_facets(queryset):
+    # Number of items in `queryset` carrying each tag
+    through = models.Item.tags.through
+    counts = through.objects.filter(item__in=queryset.order_by().values('pk')) \
+                            .values('tag__name') \
+                            .annotate(count=Count('item_id')) \
+                            .order_by('tag__name')
+    return [{"name": row['tag__name'], "count": row['count']} for row in counts]
+
+
+# Custom field filters: `cf.<name>=value` or `cf.<name>__<lookup>=value`
+CUSTOM_FIELD_PREFIX = 'cf.'
+CUSTOM_FIELD_LOOKUPS = {
+    'exact': operator.eq,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
+}
+CUSTOM_FIELD_OUTPUT = {'Single': TextField(), 'Multi': TextField(), 'Int': IntegerField(), 'Float': FloatField()}
+
+def filter_by_custom_values(queryset, fields, filters):
+    # `fields` maps names to the CustomFields the user may filter on and
+    # `filters` is a list of (name, lookup, value). Each filter is a single
+    # lookup on the (field, value) index. Items without a stored value have
+    # the field's default (see SPARSE_CUSTOM_VALUES), so when the default
+    # matches we exclude the items whose stored value doesn't instead.
+    # Raises ValueError for unknown fields, lookups or values.
+    for name, lookup, value in filters:
+        field = fields.get(name, None)
+        if field is None:
+            raise ValueError("Custom field '{}' does not exist.".format(name))
+        if lookup not in CUSTOM_FIELD_LOOKUPS:
+            raise ValueError("Unsupported lookup '{}' for custom field '{}'.".format(lookup, name))
+        try:
+            value = models.FIELD_TYPE_DICT[field.field_type](value)
+        except ValueError:
+            raise ValueError("Value '{}' is not of type '{}' (custom field '{}').".format(
+                value, models.FIELD_TYPE_DICT[field.field_type].__name__, name))
+
+        values = models.CustomValue.objects.filter(field=field)
+        condition = {'{}__{}'.format(field.field_type, lookup): value}
+        if CUSTOM_FIELD_LOOKUPS[lookup](models.default_value(field.field_type), value):
+            queryset = queryset.exclude(pk__in=values.exclude(**condition).values('item_id'))
+        else:
+            queryset = queryset.filter(pk__in=values.filter(**condition).values('item_id'))
+    return queryset
+
+def order_by_custom_value(queryset, field, descending=False):
+    # Annotate each item with its value for `field` (or the default if it has
+    # none stored) as `custom_sort` and order by it. This is an aggregate, so
+    # keyset pagination can still filter on it.
+    value = Max(Case(When(values__field=field, then=F('values__' + field.field_type)),
+                     output_field=CUSTOM_FIELD_OUTPUT[field.field_type]))
+    value = Coalesce(value, Value(models.default_value(field.field_type)),
+                     output_field=CUSTOM_FIELD_OUTPUT[field.field_type])
+    return queryset.annotate(custom_sort=value).order_by(('-' if descending else '') + 'custom_sort', 'name')
@@ -3,13 +3,16 @@ from rest_framework.exceptions import ValidationError
 from . import models
 from django.contrib.auth.models import User
 from django.utils import timezone
+from django.db import transaction
 import dateutil.parser
 from datetime import datetime
-from django.db.models import Q, F, Count
+from django.db.models import Q, Count, Manager, Prefetch, Sum, Case, When, IntegerField
 from .validators import validate_file_extension
+from . import caches, search, stock
+from collections import OrderedDict
 
 
-import re, json
+import re, json, copy
 
 from rest_framework.utils.serializer_helpers import BindingDict
 
@@ -29,28 +32,66 @@ class CustomFieldSerializer(serializers.ModelSerializer):
             raise ValidationError({"name": ["A field with name \'{}\' already exists.".format(name)]})
         return data
 
+# Prebuilt DRF fields for the custom fields, keyed by (staff, asset_tracked).
+# Each entry is rebuilt only when the custom field version changes.
+_custom_field_schemas = {}
+
+def build_custom_field(field_type):
+    if field_type == "Single":
+        return serializers.CharField(required=False, allow_blank=True, default="")
+    elif field_type == "Multi":
+        return serializers.CharField(required=False, allow_blank=True, default="")
+    elif field_type == "Int":
+        return serializers.IntegerField(required=False, default=0)
+    elif field_type == "Float":
+        return serializers.FloatField(required=False, default=0.0)
+
+def get_custom_field_schema(request, asset_tracked=False):
+    user = request.user
+    is_staff = user.is_staff or user.is_superuser
+    version = caches.get_version(caches.CUSTOM_FIELD_VERSION, request=request)
+
+    key = (is_staff, asset_tracked)
+    cached = _custom_field_schemas.get(key, None)
+    if cached is None or cached[0] != version:
+        custom_fields = models.CustomField.objects.all()
+        if asset_tracked:
+            custom_fields = custom_fields.filter(asset_tracked=True)
+        if not is_staff:
+            custom_fields = custom_fields.filter(private=False)
+
+        schema = OrderedDict()
+        for custom_field in custom_fields:
+            schema[custom_field.name] = build_custom_field(custom_field.field_type)
+        cached = (version, schema)
+        _custom_field_schemas[key] = cached
+    return cached[1]
+
+def unpack_custom_values(request, packed_values, asset_tracked=False):
+    # Read the custom values out of an Item's or Asset's packed document. Fields
+    # without a stored value get their default, and private fields are left out
+    # for non-staff users.
+    values = json.loads(packed_values)
+    schema = get_custom_field_schema(request, asset_tracked=asset_tracked)
+    return [(field_name, values.get(field_name, field.default)) for field_name, field in schema.items()]
+
+def save_custom_values(owner, validated_data):
+    # `owner` is an Item or Asset
+    searchable_changed = False
+    for field in models.CustomField.objects.filter(name__in=list(validated_data.keys())):
+        searchable_changed = models.set_custom_value(owner.values, field, validated_data[field.name]) or searchable_changed
+    if searchable_changed:
+        search.refresh_search_text([owner.pk])
+    owner.packed_values = models.refresh_packed_values(type(owner), [owner.pk])[owner.pk]
+
 class AssetSerializer(serializers.Serializer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        custom_fields = None
-        user = self.context['request'].user
-        if user.is_staff or user.is_superuser:
-            custom_fields = models.CustomField.objects.filter(asset_tracked=True)
-        else:
-            custom_fields = models.CustomField.objects.filter(asset_tracked=True, private=False)
-
         self.fields['tag'] = serializers.CharField(required=False)
 
-        for custom_field in custom_fields:
-            ft = custom_field.field_type
-            if ft == "Single":
-                self.fields[custom_field.name] = serializers.CharField(required=False, allow_blank=True, default="")
-            elif ft == "Multi":
-                self.fields[custom_field.name] = serializers.CharField(required=False, allow_blank=True, default="")
-            elif ft == "Int":
-                self.fields[custom_field.name] = serializers.IntegerField(required=False, default=0)
-            elif ft == "Float":
-                self.fields[custom_field.name] = serializers.FloatField(required=False, default=0.0)
+        schema = get_custom_field_schema(self.context['request'], asset_tracked=True)
+        for field_name, field in schema.items():
+            self.fields[field_name] = copy.deepcopy(field)
 
     def validate(self, data):
         tag = data.get("tag",None)
@@ -75,51 +116,41 @@ class AssetSerializer(serializers.Serializer):
 
         if asset.status == models.LOANED:
             d.update({"loan": LoanSerializer(context=self.context,
-                                             instance=asset.loans.filter(quantity_loaned__gt=F('quantity_returned')).get(asset__tag=asset.tag)).data})
+                                             instance=asset.loans.filter(outstanding=True).get(asset__tag=asset.tag)).data})
 
         if asset.status == models.DISBURSED:
             d.update({"disbursement": DisbursementSerializer(context=self.context,
                                                              instance=asset.disbursements.first()).data})
 
-        for cv in asset.values.all():
-            field_name = cv.field.name
-            val = cv.get_value()
-            d[field_name] = val
+        d.update(unpack_custom_values(self.context['request'], asset.packed_values, asset_tracked=True))
         return d
 
     def update(self, asset, validated_data):
         asset.tag = validated_data.pop('tag', asset.tag)
 
-        for field_name, value in validated_data.items():
-            cv = asset.values.get(field__name=field_name)
-            setattr(cv, cv.field.field_type, value)
-            cv.save()
+        save_custom_values(asset, validated_data)
 
         asset.save()
         return asset
 
+class ItemListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # Load the cart quantities, tags and custom values for the whole page
+        # up front, so each item is built from memory instead of from 3+ queries.
+        items = list(data.all() if isinstance(data, Manager) else data)
+        self.child.hydrate(items)
+        return [self.child.to_representation(item) for item in items]
+
 class ItemSerializer(serializers.Serializer):
+    class Meta:
+        list_serializer_class = ItemListSerializer
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        custom_fields = None
-        user = self.context['request'].user
-
-        if user.is_staff or user.is_superuser:
-            custom_fields = models.CustomField.objects.all()
-        else:
-            custom_fields = models.CustomField.objects.filter(private=False)
-
-        for custom_field in custom_fields:
-            ft = custom_field.field_type
-            if ft == "Single":
-                self.fields[custom_field.name] = serializers.CharField(required=False, allow_blank=True, default="")
-            elif ft == "Multi":
-                self.fields[custom_field.name] = serializers.CharField(required=False, allow_blank=True, default="")
-            elif ft == "Int":
-                self.fields[custom_field.name] = serializers.IntegerField(required=False, default=0)
-            elif ft == "Float":
-                self.fields[custom_field.name] = serializers.FloatField(required=False, default=0.0)
+        schema = get_custom_field_schema(self.context['request'])
+        for field_name, field in schema.items():
+            self.fields[field_name] = copy.deepcopy(field)
 
     name          = serializers.CharField(required=True,  allow_blank=False)
     quantity      = serializers.IntegerField(min_value=0,  required=True)
@@ -129,30 +160,50 @@ class ItemSerializer(serializers.Serializer):
     has_assets    = serializers.BooleanField(required=False)
     minimum_stock = serializers.IntegerField(min_value=0, required=False)
 
+    def hydrate(self, items):
+        # Batch-load the cart quantities and tags `to_representation` needs for
+        # `items` in two queries (custom values come from the packed document).
+        # Items that were not hydrated fall back to per-item lookups.
+        self._batch = {item.pk: {"in_cart": 0, "tags": []} for item in items}
+        if not self._batch:
+            return
+        pks = list(self._batch.keys())
+
+        user = self.context['request'].user
+        cart_items = models.CartItem.objects.filter(owner__pk=user.pk, item__pk__in=pks) \
+                                            .values_list('item_id', 'quantity')
+        for item_pk, quantity in cart_items:
+            self._batch[item_pk]["in_cart"] = quantity
+
+        item_tags = models.Item.tags.through.objects.filter(item_id__in=pks) \
+                                                    .order_by('tag__name') \
+                                                    .values_list('item_id', 'tag__name')
+        for item_pk, tag_name in item_tags:
+            self._batch[item_pk]["tags"].append(tag_name)
+
     def to_representation(self, item):
-        in_cart = 0
-        try:
-            user = self.context['request'].user
-            ci = models.CartItem.objects.filter(owner__pk=user.pk).get(item__pk=item.pk)
-            in_cart = ci.quantity
-        except:
-            pass
+        batch = getattr(self, '_batch', {}).get(item.pk, None)
+        if batch is None:
+            batch = {"in_cart": 0, "tags": [tag.name for tag in item.tags.all()]}
+            try:
+                user = self.context['request'].user
+                ci = models.CartItem.objects.filter(owner__pk=user.pk).get(item__pk=item.pk)
+                batch["in_cart"] = ci.quantity
+            except:
+                pass
 
         d = {
             "name": item.name,
             "quantity": item.quantity,
             "description": item.description,
             "model_no": item.model_no,
-            "tags": [tag.name for tag in item.tags.all()],
+            "tags": batch["tags"],
             "has_assets": item.has_assets,
-            "in_cart": in_cart,
+            "in_cart": batch["in_cart"],
             "minimum_stock": item.minimum_stock
         }
 
-        for cv in item.values.all():
-            field_name = cv.field.name
-            val = cv.get_value()
-            d[field_name] = val
+        d.update(unpack_custom_values(self.context['request'], item.packed_values))
 
         return d
 
@@ -210,10 +261,7 @@ class ItemSerializer(serializers.Serializer):
             for tag in tags:
                 item.tags.add(tag)
 
-        for field_name, value in validated_data.items():
-            cv = item.values.get(field__name=field_name)
-            setattr(cv, cv.field.field_type, value)
-            cv.save()
+        save_custom_values(item, validated_data)
 
         item.save()
         return item
@@ -237,10 +285,7 @@ class ItemSerializer(serializers.Serializer):
             for tag in tags:
                 item.tags.add(tag)
 
-        for field_name, value in validated_data.items():
-            cv = item.values.get(field__name=field_name)
-            setattr(cv, cv.field.field_type, value)
-            cv.save()
+        save_custom_values(item, validated_data)
 
         # Converting an item from asset-tracked to non-asset-tracked.
         # Delete every asset instance.
@@ -276,8 +321,7 @@ class ItemSerializer(serializers.Serializer):
         # Do not modify existing loans/disbursements/backfills.
         # When we return a loan, we should make a new Asset.
         elif has_assets_old == False and has_assets_new == True:
-                for i in range(item.quantity):
-                    asset = models.Asset.objects.create(item=item)
+                models.create_assets(item, item.quantity)
 
         item.save()
         return item
@@ -365,28 +409,29 @@ class TransactionSerializer(serializers.ModelSerializer):
         return data
 
     def create(self, validated_data):
-        transaction = super().create(validated_data)
-        item = transaction.item
-
-        if transaction.item.has_assets:
-            if transaction.category == models.LOSS:
-                for asset in transaction.assets.all():
-                    asset.status = models.LOST
-                    asset.save()
-
-            elif transaction.category == models.ACQUISITION:
-                for i in range(transaction.quantity):
-                    asset = models.Asset.objects.create(item=transaction.item)
-                    transaction.assets.add(asset)
+        with transaction.atomic():
+            # move the stock first, items are locked before assets (see stock.py)
+            item = validated_data['item']
+            try:
+                if validated_data['category'] == models.LOSS:
+                    stock.adjust_stock(item, -validated_data['quantity'])
+                elif validated_data['category'] == models.ACQUISITION:
+                    stock.adjust_stock(item, validated_data['quantity'])
+            except stock.StockError as e:
+                raise ValidationError(e.errors)
+
+            instance = super().create(validated_data)
+            if item.has_assets:
+                if instance.category == models.LOSS:
+                    for asset in instance.assets.all():
+                        asset.status = models.LOST
+                        asset.save()
 
-        if transaction.category == models.LOSS:
-            item.quantity -= transaction.quantity
-        elif transaction.category == models.ACQUISITION:
-            item.quantity += transaction.quantity
+                elif instance.category == models.ACQUISITION:
+                    assets = models.create_assets(item, instance.quantity)
+                    instance.assets.add(*assets)
 
-        item.save()
-        transaction.save()
-        return transaction
+        return instance
 
 
 
@@ -512,6 +557,15 @@ class RequestSerializer(serializers.ModelSerializer):
         fields = ['id', 'requester', 'administrator', 'status', 'requested_items', 'approved_items', 'date_open', 'open_comment', 'date_closed',
                   'closed_comment']
 
+    @staticmethod
+    def prefetch(queryset):
+        # Load everything the representation touches up front, so serializing
+        # a page of requests takes the same few queries however long it is.
+        return queryset.select_related('requester', 'administrator') \
+                       .prefetch_related(Prefetch('requested_items', queryset=models.RequestedItem.objects.select_related('item')),
+                                         Prefetch('approved_items', queryset=models.ApprovedItem.objects.select_related('item')),
+                                         Prefetch('approved_items__assets', queryset=models.Asset.objects.only('tag')))
+
     def to_representation(self, instance):
         data = super().to_representation(instance)
         if not instance.status == "A":
@@ -614,21 +668,117 @@ class RequestPUTSerializer(serializers.ModelSerializer):
         approved_items = data.pop('approved_items', [])
 
         if data.get('status', None) == "A":
-            ai_instances = []
-            for approved_item in approved_items:
-                item = approved_item.get('item', None)
-                quantity = approved_item.get('quantity', 0)
-                request_type = approved_item.get('request_type', models.LOAN)
-                assets = approved_item.get('assets', [])
+            # locks the stock and re-validates against it, see stock.py
+            try:
+                stock.approve_requests([{"request": instance,
+                                         "approved_items": approved_items,
+                                         "closed_comment": data.get('closed_comment', '')}],
+                                       data.get('administrator', None))
+            except stock.ApprovalError as e:
+                raise ValidationError(e.errors)
 
-                ai = models.ApprovedItem(request=instance, item=item, quantity=quantity, request_type=request_type)
-                ai.save(assets=assets)
+        return super().update(instance, data)
 
-                ai_instances.append(ai)
+class BulkApprovedItemSerializer(serializers.Serializer):
+    # Like ApprovedItemSerializer, but the item and assets are resolved for the
+    # whole batch at once by BulkRequestDecisionSerializer
+    item         = serializers.CharField()
+    quantity     = serializers.IntegerField(min_value=1)
+    request_type = serializers.ChoiceField(choices=models.ITEM_REQUEST_TYPES, default=models.LOAN)
+    assets       = serializers.ListField(child=serializers.IntegerField(), required=False, default=[])
 
-        return super().update(instance, data)
+class RequestDecisionSerializer(serializers.Serializer):
+    # `status` may be the display name ('Approved', 'Denied') or the stored key
+    # ('A', 'D'); it is validated to the key
+    DECISIONS = {'Approved': models.APPROVED, 'Denied': models.DENIED}
+
+    request        = serializers.IntegerField()
+    status         = serializers.CharField()
+    closed_comment = serializers.CharField(allow_blank=True, default="")
+    # left out when approving: approve the requested items as requested
+    approved_items = BulkApprovedItemSerializer(many=True, required=False)
+
+    def validate_status(self, value):
+        if value in self.DECISIONS.values():
+            return value
+        if value.capitalize() in self.DECISIONS:
+            return self.DECISIONS[value.capitalize()]
+        raise ValidationError("Status must be one of 'Approved', 'Denied'.")
+
+class BulkRequestDecisionSerializer(serializers.Serializer):
+    decisions = RequestDecisionSerializer(many=True)
+
+    def validate(self, data):
+        # Look up every request, item and asset named in the batch with one
+        # query each. Stock is checked later, under lock, by stock.py.
+        decisions = data.get('decisions', [])
+        request_pks = [decision['request'] for decision in decisions]
+        requests = models.Request.objects.select_related('requester').in_bulk(request_pks)
+        requested_items = {}
+        for ri in models.RequestedItem.objects.filter(request__pk__in=request_pks).select_related('item'):
+            requested_items.setdefault(ri.request_id, []).append(ri)
+
+        item_names = set()
+        asset_tags = set()
+        for decision in decisions:
+            for approved_item in decision.get('approved_items', []):
+                item_names.add(approved_item['item'])
+                asset_tags.update(approved_item['assets'])
+        items = {item.name: item for item in models.Item.objects.filter(name__in=item_names)}
+        assets = {asset.tag: asset for asset in models.Asset.objects.filter(tag__in=asset_tags)}
+
+        errors = {}
+        seen = set()
+        for decision in decisions:
+            pk = decision['request']
+            request_errors = {}
+            if pk in seen:
+                request_errors['request'] = ["Request with ID {} is listed more than once.".format(pk)]
+            seen.add(pk)
+            if pk not in requests:
+                errors[pk] = {'request': ["Request with ID {} not found.".format(pk)]}
+                continue
+            decision['request'] = requests[pk]
+
+            if decision['status'] == models.APPROVED and 'approved_items' not in decision:
+                decision['approved_items'] = [{'item': ri.item, 'quantity': ri.quantity, 'request_type': ri.request_type, 'assets': []}
+                                              for ri in requested_items.get(pk, [])]
+            else:
+                for approved_item in decision.get('approved_items', []):
+                    name = approved_item['item']
+                    if name not in items:
+                        request_errors[name] = ["Item '{}' not found.".format(name)]
+                        continue
+                    approved_item['item'] = items[name]
+                    missing = [tag for tag in approved_item['assets'] if tag not in assets]
+                    if missing:
+                        request_errors[name] = ["Asset with tag {} not found.".format(tag) for tag in missing]
+                        continue
+                    approved_item['assets'] = [assets[tag] for tag in approved_item['assets']]
+            if request_errors:
+                errors[pk] = request_errors
+
+        if errors:
+            raise ValidationError(errors)
+        return data
 
 class RequestLoanDisbursementSerializer(serializers.Serializer):
+    @staticmethod
+    def prefetch(queryset):
+        # RequestSerializer.prefetch() plus the loans, disbursements and backfills,
+        # so a page costs the same few queries however long it is. Also counts each
+        # request's outstanding and returned loans (as outstanding_loans and
+        # returned_loans), which the loan lists filter on.
+        backfill_requests = models.BackfillRequest.objects.select_related('request__requester', 'item', 'asset', 'loan__item', 'loan__asset')
+        queryset = RequestSerializer.prefetch(queryset)
+        return queryset.prefetch_related(Prefetch('loans', queryset=models.Loan.objects.select_related('item', 'asset')),
+                                         Prefetch('loans__backfill_requests', queryset=backfill_requests),
+                                         Prefetch('disbursements', queryset=models.Disbursement.objects.select_related('item', 'asset')),
+                                         Prefetch('backfill_requests', queryset=backfill_requests),
+                                         Prefetch('backfills', queryset=models.Backfill.objects.select_related('item', 'asset'))) \
+                       .annotate(outstanding_loans=Sum(Case(When(loans__outstanding=True, then=1), default=0, output_field=IntegerField())),
+                                 returned_loans=Sum(Case(When(loans__outstanding=False, then=1), default=0, output_field=IntegerField())))
+
     def to_representation(self, request):
         request_json = RequestSerializer(context=self.context, instance=request).data
         loans = LoanSerializerNoRequest(instance=request.loans.all(), many=True).data
@@ -642,6 +792,11 @@ class RequestLoanDisbursementSerializer(serializers.Serializer):
             "backfill_requests": backfill_requests,
             "request": request_json
         }
+        if hasattr(request, 'outstanding_loans'):
+            d["loan_summary"] = {"outstanding": request.outstanding_loans, "returned": request.returned_loans}
+        else:
+            outstanding = sum(1 for loan in request.loans.all() if loan.outstanding)
+            d["loan_summary"] = {"outstanding": outstanding, "returned": len(request.loans.all()) - outstanding}
         return d
 
 class LoanSerializer(serializers.ModelSerializer):
@@ -670,8 +825,7 @@ class LoanSerializer(serializers.ModelSerializer):
         loan = super(LoanSerializer, self).update(instance, validated_data)
         new_quantity = loan.quantity_returned
 
-        loan.item.quantity += (new_quantity - old_quantity)
-        loan.item.save()
+        stock.adjust_stock(loan.item, new_quantity - old_quantity)
 
         # Loan was fully returned.
         if loan.quantity_returned == loan.quantity_loaned:
@@ -696,8 +850,7 @@ class LoanSerializer(serializers.ModelSerializer):
                 # we returned several untracked instances. delete this loan object, and instead
                 # create one new loan object for each instance we are returning.
                 else:
-                    for i in range(new_quantity - old_quantity):
-                        asset = models.Asset.objects.create(item=loan.item)
+                    for asset in models.create_assets(loan.item, new_quantity - old_quantity):
                         new_loan = models.Loan.objects.create(request=loan.request, item=loan.item, asset=asset, quantity_loaned=1, quantity_returned=1)
                         loan.quantity_returned -= 1
                         loan.quantity_loaned -= 1
@@ -706,8 +859,7 @@ class LoanSerializer(serializers.ModelSerializer):
         # Loan was partially returned.
         else:
             if (loan.item.has_assets and loan.asset == None):
-                for i in range(new_quantity - old_quantity):
-                    asset = models.Asset.objects.create(item=loan.item)
+                for asset in models.create_assets(loan.item, new_quantity - old_quantity):
                     new_loan = models.Loan.objects.create(request=loan.request, item=loan.item, asset=asset, quantity_loaned=1, quantity_returned=1)
                     loan.quantity_loaned -= 1
                     loan.quantity_returned -= 1
@@ -715,6 +867,65 @@ class LoanSerializer(serializers.ModelSerializer):
 
         return loan
 
+def resolve_loans(entries):
+    # Replace the loan ids in `entries` (dicts with a "loan" key) with the loans,
+    # looked up in one query. Raises ValidationError keyed by loan id for unknown
+    # or repeated loans.
+    loans = models.Loan.objects.select_related('request__requester', 'item', 'asset').in_bulk([entry['loan'] for entry in entries])
+    errors = {}
+    seen = set()
+    for entry in entries:
+        pk = entry['loan']
+        if pk in seen:
+            errors[pk] = ["Loan with ID {} is listed more than once.".format(pk)]
+        elif pk not in loans:
+            errors[pk] = ["Loan with ID {} not found.".format(pk)]
+        else:
+            entry['loan'] = loans[pk]
+        seen.add(pk)
+    if errors:
+        raise serializers.ValidationError(errors)
+
+class LoanReturnSerializer(serializers.Serializer):
+    loan              = serializers.IntegerField()
+    # how many more instances came back
+    quantity_returned = serializers.IntegerField(min_value=1)
+
+class BulkLoanReturnSerializer(serializers.Serializer):
+    returns = LoanReturnSerializer(many=True)
+
+    def validate(self, data):
+        # quantities are checked later, under lock, by stock.py
+        resolve_loans(data['returns'])
+        return data
+
+class LoanConversionSerializer(serializers.Serializer):
+    loan     = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
+
+class BulkConversionSerializer(serializers.Serializer):
+    # either a list of conversions, or item and/or user to convert everything
+    # still outstanding on the matching loans
+    conversions = LoanConversionSerializer(many=True, required=False)
+    item        = serializers.CharField(required=False)
+    user        = serializers.CharField(required=False)
+
+    def validate(self, data):
+        has_filter = 'item' in data or 'user' in data
+        if ('conversions' in data) == has_filter:
+            raise serializers.ValidationError({"error": ["Specify either conversions or an item and/or user."]})
+        if has_filter:
+            loans = models.Loan.objects.filter(outstanding=True).select_related('request__requester', 'item', 'asset')
+            if 'item' in data:
+                loans = loans.filter(item__name=data['item'])
+            if 'user' in data:
+                loans = loans.filter(request__requester__username=data['user'])
+            data['conversions'] = [{"loan": loan, "quantity": loan.quantity_loaned - loan.quantity_returned} for loan in loans]
+        else:
+            # quantities are checked later, under lock, by stock.py
+            resolve_loans(data['conversions'])
+        return data
+
 class LoanSerializerNoBackfillRequest(serializers.ModelSerializer):
     item = serializers.SlugRelatedField(slug_field="name", read_only=True)
 
@@ -874,14 +1085,9 @@ class BackfillPUTSerializer(serializers.ModelSerializer):
         status = data.get('status')
         if status == models.SATISFIED:
             item = backfill.item
+            stock.adjust_stock(item, backfill.quantity)
             if item.has_assets:
-                for i in range(backfill.quantity):
-                    asset = models.Asset.objects.create(item=item)
-                item.quantity += backfill.quantity
-                item.save()
-            else:
-                item.quantity += backfill.quantity
-                item.save()
+                models.create_assets(item, backfill.quantity)
 
         super().update(backfill, data)
         return backfill
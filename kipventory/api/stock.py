@@ -0,0 +1,476 @@
+from django.db import transaction
+from django.db.models import F, Sum, Count, Min, Case, When, Value, IntegerField, BooleanField
+from django.utils import timezone
+from collections import defaultdict
+from datetime import timedelta
+import copy
+from . import caches, models
+
+# Request approval. Everything an approval touches is locked up front in one
+# fixed order (requests, then items, then assets, each by primary key), so two
+# managers approving at the same time wait for each other instead of
+# deadlocking, and stock is checked against the locked rows so it can't be oversold.
+
+
+class StockError(Exception):
+    # `errors` is keyed like serializer errors, e.g. {item name: [messages]}
+    def __init__(self, errors):
+        super(StockError, self).__init__(errors)
+        self.errors = errors
+
+class ApprovalError(StockError):
+    pass
+
+class ReturnError(StockError):
+    pass
+
+class ConversionError(StockError):
+    pass
+
+
+def approve_requests(approvals, administrator):
+    # `approvals` is a list of {"request", "approved_items", "closed_comment"},
+    # where each approved item is {"item", "quantity", "request_type", "assets"}
+    # as validated by RequestPUTSerializer. Either every request is approved or
+    # ApprovalError is raised and nothing changes. Returns the ApprovedItems.
+    try:
+        return decide_requests(approvals, [], administrator)
+    except ApprovalError as e:
+        if len(approvals) != 1:
+            raise
+        # a single request gets its errors flat, like RequestPUTSerializer's
+        errors = e.errors.get(approvals[0]["request"].pk, {})
+        for item_name, messages in e.errors.get("stock", {}).items():
+            errors.setdefault(item_name, []).extend(messages)
+        raise ApprovalError(errors)
+
+def decide_requests(approvals, denials, administrator):
+    # Approve and deny requests in one go. `denials` is a list of
+    # {"request", "closed_comment"}. All the requests are locked together so
+    # the lock order holds.
+    if not approvals and not denials:
+        return []
+
+    with transaction.atomic():
+        request_pks = [approval["request"].pk for approval in approvals]
+        denied_pks = [denial["request"].pk for denial in denials]
+        requests = {request.pk: request for request in models.Request.objects.select_for_update()
+                                                                  .filter(pk__in=request_pks + denied_pks).order_by('pk')}
+
+        item_pks = set()
+        asset_pks = set()
+        for approval in approvals:
+            for approved_item in approval["approved_items"]:
+                item_pks.add(approved_item["item"].pk)
+                asset_pks.update(asset.pk for asset in approved_item.get("assets", []))
+        items = {item.pk: item for item in models.Item.objects.select_for_update().filter(pk__in=item_pks).order_by('pk')}
+        assets = {asset.pk: asset for asset in models.Asset.objects.select_for_update().filter(pk__in=asset_pks).order_by('pk')}
+
+        errors = validate_approvals(approvals, requests, items, assets)
+        for denial in denials:
+            request = requests.get(denial["request"].pk, None)
+            if request is None or request.status != models.OUTSTANDING:
+                errors.setdefault(denial["request"].pk, {})["status"] = ["Only outstanding requests may be denied."]
+            if denial["request"].pk in request_pks:
+                errors.setdefault(denial["request"].pk, {})["status"] = ["Request can't be both approved and denied."]
+        if errors:
+            raise ApprovalError(errors)
+
+        now = timezone.now()
+        approved_items = []
+        asset_tags = {}
+        for approval in approvals:
+            request = requests[approval["request"].pk]
+            for approved_item in approval["approved_items"]:
+                ai = models.ApprovedItem(request=request,
+                                         item=items[approved_item["item"].pk],
+                                         quantity=approved_item["quantity"],
+                                         request_type=approved_item.get("request_type", models.LOAN))
+                approved_items.append(ai)
+                asset_tags[(request.pk, ai.item_id)] = [assets[asset.pk] for asset in approved_item.get("assets", [])]
+        models.ApprovedItem.objects.bulk_create(approved_items)
+        # bulk_create doesn't set primary keys on every backend; each (request, item)
+        # pair is unique and the requests are locked, so look them up again
+        approved_pks = dict(((request_pk, item_pk), pk) for pk, request_pk, item_pk in
+                            models.ApprovedItem.objects.filter(request__pk__in=request_pks)
+                                                       .values_list('pk', 'request_id', 'item_id'))
+        for ai in approved_items:
+            ai.pk = approved_pks[(ai.request_id, ai.item_id)]
+
+        loans = []
+        disbursements = []
+        approved_assets = []
+        taken = defaultdict(int)
+        status_changes = defaultdict(list)
+        for ai in approved_items:
+            ai_assets = asset_tags[(ai.request_id, ai.item_id)]
+            approved_assets.extend(models.ApprovedItem.assets.through(approveditem_id=ai.pk, asset_id=asset.pk) for asset in ai_assets)
+            if ai.request_type == models.DISBURSEMENT:
+                new_status = models.DISBURSED
+                disbursements.extend(models.Disbursement(request=ai.request, item=ai.item, asset=asset, quantity=1) for asset in ai_assets)
+                if not ai_assets:
+                    disbursements.append(models.Disbursement(request=ai.request, item=ai.item, quantity=ai.quantity))
+            else:
+                new_status = models.LOANED
+                loans.extend(models.Loan(request=ai.request, item=ai.item, asset=asset, quantity_loaned=1) for asset in ai_assets)
+                if not ai_assets:
+                    loans.append(models.Loan(request=ai.request, item=ai.item, quantity_loaned=ai.quantity))
+            taken[ai.item_id] += len(ai_assets) if ai_assets else ai.quantity
+            status_changes[new_status].extend(ai_assets)
+
+        models.ApprovedItem.assets.through.objects.bulk_create(approved_assets)
+        models.Loan.objects.bulk_create(loans)
+        models.Disbursement.objects.bulk_create(disbursements)
+
+        for new_status, changed in status_changes.items():
+            move_assets(changed, new_status)
+
+        for item_pk, n in taken.items():
+            models.Item.objects.filter(pk=item_pk).update(quantity=F('quantity') - n)
+
+        for decision, new_status in [(approval, models.APPROVED) for approval in approvals] + \
+                                    [(denial, models.DENIED) for denial in denials]:
+            models.Request.objects.filter(pk=decision["request"].pk).update(status=new_status,
+                                                                           administrator=administrator,
+                                                                           date_closed=now,
+                                                                           closed_comment=decision.get("closed_comment", ""))
+        if approved_items:
+            caches.bump_version(caches.INVENTORY_VERSION)
+    return approved_items
+
+
+def move_assets(assets, new_status):
+    # Set the status of `assets` in one query. Bulk updates skip Asset.save(),
+    # so this moves the item counters itself.
+    if not assets:
+        return
+    models.Asset.objects.filter(pk__in=[asset.pk for asset in assets]).update(status=new_status)
+    moved = defaultdict(int)
+    for asset in assets:
+        moved[(asset.item_id, asset.status)] += 1
+    for (item_pk, old_status), n in moved.items():
+        models.update_asset_counts(item_pk, old_status, -n)
+        models.update_asset_counts(item_pk, new_status, n)
+    for asset in assets:
+        asset.status = new_status
+
+def adjust_stock(item, delta):
+    # Add `delta` (negative to take stock away) to the item's quantity in a
+    # single UPDATE, so it can't overwrite a concurrent approval's decrement.
+    # Raises StockError instead of letting the quantity go below zero.
+    updated = models.Item.objects.filter(pk=item.pk, quantity__gte=max(-delta, 0)).update(quantity=F('quantity') + delta)
+    if not updated:
+        raise StockError({"quantity": ["You may not remove more instances than are currently in stock."]})
+    item.quantity = models.Item.objects.filter(pk=item.pk).values_list('quantity', flat=True).get()
+    # so a later item.save() doesn't write the value back
+    item._quantity_snapshot = item.quantity
+    caches.bump_version(caches.INVENTORY_VERSION)
+
+def validate_approvals(approvals, requests, items, assets):
+    # Check the approvals against the locked rows. Returns serializer style
+    # errors keyed by request pk, plus "stock" for items short of stock.
+    errors = {}
+    demand = defaultdict(int)
+    for approval in approvals:
+        request_errors = {}
+        request = requests.get(approval["request"].pk, None)
+        if request is None or request.status != models.OUTSTANDING:
+            request_errors["status"] = ["Only outstanding requests may be approved."]
+
+        seen = set()
+        for approved_item in approval["approved_items"]:
+            item = items[approved_item["item"].pk]
+            quantity = approved_item["quantity"]
+            item_errors = []
+            if item.pk in seen:
+                item_errors.append("Item {} is listed more than once.".format(item.name))
+            seen.add(item.pk)
+
+            if item.has_assets:
+                ai_assets = [assets[asset.pk] for asset in approved_item.get("assets", [])]
+                if len(ai_assets) != quantity or len(set(asset.pk for asset in ai_assets)) != quantity:
+                    item_errors.append("Must specify {} unique asset tag(s).".format(quantity))
+                for asset in ai_assets:
+                    if asset.status != models.IN_STOCK:
+                        item_errors.append("Asset with tag {} is not in stock.".format(asset.tag))
+                    if asset.item_id != item.pk:
+                        item_errors.append("Asset with tag {} is not an instance of item {}.".format(asset.tag, item.name))
+            demand[item.pk] += quantity
+            if item_errors:
+                request_errors[item.name] = item_errors
+
+        if request_errors:
+            errors[request.pk if request is not None else approval["request"].pk] = request_errors
+
+    for item_pk, quantity in demand.items():
+        item = items[item_pk]
+        if quantity > item.quantity:
+            message = "Request for {} instances of '{}' exceeds current stock of {}.".format(quantity, item.name, item.quantity)
+            errors.setdefault("stock", {}).setdefault(item.name, []).append(message)
+
+    return errors
+
+
+# Loan returns. Loans are locked by primary key, then items and assets are
+# written in the same order approvals lock them in.
+
+# Loans updated per UPDATE statement
+UPDATE_CHUNK_SIZE = 500
+
+def return_loans(returns, administrator):
+    # `returns` is a list of {"loan", "quantity_returned"}, the quantity being
+    # how many more instances came back, as validated by BulkLoanReturnSerializer.
+    # Does what LoanSerializer.update() does for a single return, in bulk, and
+    # either applies every return or raises ReturnError. Returns the returned
+    # loans as they were after the return but before any split (see below).
+    with transaction.atomic():
+        loan_pks = [loan_return["loan"].pk for loan_return in returns]
+        loans = {loan.pk: loan for loan in models.Loan.objects.select_for_update()
+                                                          .filter(pk__in=loan_pks).order_by('pk')}
+        # not select_related, which would lock the items and assets too
+        items = models.Item.objects.in_bulk(set(loan.item_id for loan in loans.values()))
+        assets = models.Asset.objects.in_bulk([loan.asset_id for loan in loans.values() if loan.asset_id is not None])
+
+        errors = {}
+        for loan_return in returns:
+            loan = loans.get(loan_return["loan"].pk, None)
+            quantity = loan_return["quantity_returned"]
+            if loan is None:
+                errors[loan_return["loan"].pk] = ["Loan not found."]
+            elif quantity > loan.quantity_loaned - loan.quantity_returned:
+                errors[loan.pk] = ["Quantity must not be greater than the number of outstanding instances in this loan ({})".format(loan.quantity_loaned - loan.quantity_returned)]
+        if errors:
+            raise ReturnError(errors)
+
+        returned = []
+        restocked = defaultdict(int)
+        fully_returned = []
+        assets_back = []
+        untracked = defaultdict(list)
+        for loan_return in returns:
+            loan = loans[loan_return["loan"].pk]
+            loan.item = items[loan.item_id]
+            loan.asset = assets.get(loan.asset_id, None)
+            # a loan's request never changes, so reuse whatever the caller loaded
+            loan.request = loan_return["loan"].request
+            quantity = loan_return["quantity_returned"]
+            loan.quantity_returned += quantity
+            restocked[loan.item_id] += quantity
+            returned.append(copy.copy(loan))
+
+            if loan.quantity_returned == loan.quantity_loaned:
+                fully_returned.append(loan.pk)
+                if loan.asset is not None:
+                    assets_back.append(loan.asset)
+            if loan.asset is None and loan.item.has_assets:
+                # instances loaned out while the item wasn't asset tracked get new assets
+                untracked[loan.item_id].append((loan, quantity))
+
+        # outstanding backfill requests are moot once a loan is fully returned
+        models.BackfillRequest.objects.filter(loan__pk__in=fully_returned, status=models.OUTSTANDING).delete()
+
+        for item_pk in sorted(restocked):
+            models.Item.objects.filter(pk=item_pk).update(quantity=F('quantity') + restocked[item_pk])
+        move_assets(assets_back, models.IN_STOCK)
+
+        # create the assets for untracked instances, then give a single returned
+        # instance its asset, or split each returned instance off into its own returned loan
+        split_loans = []
+        deleted = []
+        for item_pk in sorted(untracked):
+            new_assets = iter(models.create_assets(items[item_pk], sum(quantity for loan, quantity in untracked[item_pk])))
+            for loan, quantity in untracked[item_pk]:
+                if loan.quantity_loaned == 1:
+                    loan.asset = next(new_assets)
+                    continue
+                for i in range(quantity):
+                    split_loans.append(models.Loan(request_id=loan.request_id, item_id=loan.item_id, asset=next(new_assets),
+                                                   quantity_loaned=1, quantity_returned=1, outstanding=False))
+                loan.quantity_loaned -= quantity
+                loan.quantity_returned -= quantity
+                if loan.quantity_loaned == 0:
+                    deleted.append(loan.pk)
+        models.Loan.objects.bulk_create(split_loans)
+
+        changed = [loans[pk] for pk in sorted(set(loan_pks)) if pk not in deleted]
+        for loan in changed:
+            loan.outstanding = loan.quantity_loaned > loan.quantity_returned
+        update_loans(changed)
+        models.Loan.objects.filter(pk__in=deleted).delete()
+
+        caches.bump_version(caches.INVENTORY_VERSION)
+    return returned
+
+def convert_loans(conversions, administrator):
+    # `conversions` is a list of {"loan", "quantity"}, as validated by
+    # BulkConversionSerializer. Does what convertLoanToDisbursement() does for
+    # a single loan, in bulk: plain loans are merged into the request's existing
+    # disbursement of the item (or a new one), loans of asset tracked items get
+    # a disbursement each. Fully converted loans are deleted along with their
+    # outstanding backfill requests. Either every conversion is applied or
+    # ConversionError is raised. Returns (loan, quantity) pairs, the loans as
+    # they were after the conversion.
+    with transaction.atomic():
+        loan_pks = [conversion["loan"].pk for conversion in conversions]
+        loans = {loan.pk: loan for loan in models.Loan.objects.select_for_update()
+                                                          .filter(pk__in=loan_pks).order_by('pk')}
+        items = models.Item.objects.in_bulk(set(loan.item_id for loan in loans.values()))
+        assets = {asset.pk: asset for asset in models.Asset.objects.select_for_update()
+                                                               .filter(pk__in=[loan.asset_id for loan in loans.values() if loan.asset_id is not None])
+                                                               .order_by('pk')}
+
+        errors = {}
+        for conversion in conversions:
+            loan = loans.get(conversion["loan"].pk, None)
+            if loan is None:
+                errors[conversion["loan"].pk] = ["Loan not found."]
+            elif conversion["quantity"] > loan.quantity_loaned - loan.quantity_returned:
+                errors[loan.pk] = ["Quantity must not be greater than the number of outstanding instances in this loan ({})".format(loan.quantity_loaned - loan.quantity_returned)]
+        if errors:
+            raise ConversionError(errors)
+
+        converted = []
+        merged = defaultdict(int)
+        disbursements = []
+        disbursed_assets = []
+        for conversion in conversions:
+            loan = loans[conversion["loan"].pk]
+            loan.item = items[loan.item_id]
+            loan.asset = assets.get(loan.asset_id, None)
+            # see return_loans()
+            loan.request = conversion["loan"].request
+            quantity = conversion["quantity"]
+            if loan.asset is None and not loan.item.has_assets:
+                merged[(loan.request_id, loan.item_id)] += quantity
+            else:
+                disbursements.append(models.Disbursement(item_id=loan.item_id, asset=loan.asset, request_id=loan.request_id, quantity=quantity))
+                if loan.asset is not None:
+                    disbursed_assets.append(loan.asset)
+            loan.quantity_loaned -= quantity
+            loan.outstanding = loan.quantity_loaned > loan.quantity_returned
+            converted.append((copy.copy(loan), quantity))
+
+        # add to the request's first disbursement of the item, like convertLoanToDisbursement()
+        existing = {}
+        if merged:
+            request_pks = set(request_pk for request_pk, item_pk in merged)
+            item_pks = set(item_pk for request_pk, item_pk in merged)
+            for pk, request_pk, item_pk in models.Disbursement.objects.select_for_update() \
+                                                              .filter(request__pk__in=request_pks, item__pk__in=item_pks) \
+                                                              .order_by('pk').values_list('pk', 'request_id', 'item_id'):
+                existing.setdefault((request_pk, item_pk), pk)
+        added = [(existing[key], quantity) for key, quantity in merged.items() if key in existing]
+        for start in range(0, len(added), UPDATE_CHUNK_SIZE):
+            chunk = added[start:start + UPDATE_CHUNK_SIZE]
+            models.Disbursement.objects.filter(pk__in=[pk for pk, quantity in chunk]) \
+                                       .update(quantity=F('quantity') + Case(*[When(pk=pk, then=Value(quantity)) for pk, quantity in chunk],
+                                                                             output_field=IntegerField()))
+        disbursements.extend(models.Disbursement(item_id=item_pk, request_id=request_pk, quantity=quantity)
+                             for (request_pk, item_pk), quantity in merged.items() if (request_pk, item_pk) not in existing)
+        models.Disbursement.objects.bulk_create(disbursements)
+        move_assets(disbursed_assets, models.DISBURSED)
+
+        deleted = [loan.pk for loan in loans.values() if loan.quantity_loaned == 0]
+        update_loans([loans[pk] for pk in sorted(loans) if pk not in deleted])
+        models.BackfillRequest.objects.filter(loan__pk__in=deleted, status=models.OUTSTANDING).delete()
+        models.Loan.objects.filter(pk__in=deleted).delete()
+
+        if disbursed_assets:
+            caches.bump_version(caches.INVENTORY_VERSION)
+    return converted
+
+def update_loans(loans):
+    # Write the quantities, asset and outstanding flag of many loans with a few
+    # UPDATE ... CASE statements instead of one save() each.
+    for start in range(0, len(loans), UPDATE_CHUNK_SIZE):
+        chunk = loans[start:start + UPDATE_CHUNK_SIZE]
+        values = {}
+        for field, output_field in (('quantity_loaned', IntegerField()), ('quantity_returned', IntegerField()),
+                                    ('asset_id', IntegerField()), ('outstanding', BooleanField())):
+            values[field] = Case(*[When(pk=loan.pk, then=Value(getattr(loan, field))) for loan in chunk], output_field=output_field)
+        models.Loan.objects.filter(pk__in=[loan.pk for loan in chunk]).update(**values)
+
+
+# Loan aging: how long outstanding loans have been out, for managers.
+
+# (label, lower bound in days, upper bound in days or None)
+AGING_BUCKETS = (('0-7 days', 0, 7), ('8-30 days', 7, 30), ('31-90 days', 30, 90), ('over 90 days', 90, None))
+# Rows in each of the per item, per user and oldest loan lists
+AGING_LIST_LIMIT = 25
+
+def loan_aging(now=None):
+    # Aging buckets, per item and per user outstanding totals and the oldest
+    # outstanding loans, all aggregated in the database (a handful of queries
+    # however many loans there are).
+    now = now or timezone.now()
+    outstanding = models.Loan.objects.filter(outstanding=True).order_by()
+    quantity = F('quantity_loaned') - F('quantity_returned')
+
+    aggregates = {}
+    for i, (label, low, high) in enumerate(AGING_BUCKETS):
+        bounds = {'date_loaned__lte': now - timedelta(days=low)}
+        if high is not None:
+            bounds['date_loaned__gt'] = now - timedelta(days=high)
+        aggregates['loans_{}'.format(i)] = Sum(Case(When(then=1, **bounds), default=0, output_field=IntegerField()))
+        aggregates['quantity_{}'.format(i)] = Sum(Case(When(then=quantity, **bounds), default=0, output_field=IntegerField()))
+    totals = outstanding.aggregate(**aggregates)
+    buckets = [{"age": label, "loans": totals['loans_{}'.format(i)] or 0, "quantity": totals['quantity_{}'.format(i)] or 0}
+               for i, (label, low, high) in enumerate(AGING_BUCKETS)]
+
+    def grouped(field):
+        rows = outstanding.values(field).annotate(quantity=Sum(quantity), loans=Count('id'), oldest=Min('date_loaned')) \
+                          .order_by('-quantity', field)[:AGING_LIST_LIMIT]
+        return [{"name": row[field], "loans": row['loans'], "quantity": row['quantity'],
+                 "oldest_days": (now - row['oldest']).days} for row in rows]
+
+    oldest = [{"id": loan.pk,
+               "request": loan.request_id,
+               "item": loan.item.name,
+               "asset": loan.asset.tag if loan.asset is not None else None,
+               "user": loan.request.requester.username if loan.request is not None else None,
+               "quantity": loan.quantity_loaned - loan.quantity_returned,
+               "date_loaned": loan.date_loaned,
+               "days": (now - loan.date_loaned).days}
+              for loan in outstanding.select_related('item', 'asset', 'request__requester').order_by('date_loaned', 'pk')[:AGING_LIST_LIMIT]]
+
+    return {
+        "computed_at": now,
+        "buckets": buckets,
+        "items": grouped('item__name'),
+        "users": grouped('request__requester__username'),
+        "oldest": oldest,
+    }
+
+
+# Item stacks: how an item's stock breaks down, for the item detail page.
+
+def item_stacks(items, user):
+    # {item pk: stack} for `items`, with one aggregate query per source no
+    # matter how many items or how much history there is. Managers see
+    # everyone's requests, loans, disbursements and backfills, other users
+    # only their own; the cart is always the user's.
+    manager = user.is_staff or user.is_superuser
+    item_pks = [item.pk for item in items]
+
+    def totals(queryset, amount, owner_lookup=None):
+        queryset = queryset.filter(item__pk__in=item_pks)
+        if owner_lookup is not None and not manager:
+            queryset = queryset.filter(**{owner_lookup: user.pk})
+        # order_by() clears any default ordering, which would end up in the GROUP BY
+        return dict(queryset.order_by().values('item_id').annotate(total=Sum(amount)).values_list('item_id', 'total'))
+
+    requested = totals(models.RequestedItem.objects.filter(request__status=models.OUTSTANDING), 'quantity', 'request__requester')
+    loaned = totals(models.Loan.objects.filter(outstanding=True),
+                    F('quantity_loaned') - F('quantity_returned'), 'request__requester')
+    disbursed = totals(models.Disbursement.objects.all(), 'quantity', 'request__requester')
+    backfill = totals(models.Backfill.objects.filter(status=models.AWAITING_ITEMS), 'quantity', 'request__requester')
+    in_cart = totals(models.CartItem.objects.filter(owner__pk=user.pk), 'quantity')
+
+    return {item.pk: {
+        "in_stock": item.quantity,
+        "requested": requested.get(item.pk, 0),
+        "loaned": loaned.get(item.pk, 0),
+        "disbursed": disbursed.get(item.pk, 0),
+        "awaiting_backfill": backfill.get(item.pk, 0),
+        "in_cart": in_cart.get(item.pk, 0),
+    } for item in items}
@@ -0,0 +1,12 @@
+from celery import shared_task
+from . import models
+
+
+@shared_task
+def backfill_custom_values(field_name):
+    try:
+        field = models.CustomField.objects.get(name=field_name)
+    except models.CustomField.DoesNotExist:
+        # deleted before the job got to run
+        return
+    models.backfill_custom_values(field)
@@ -14,6 +14,7 @@ urlpatterns = [
     url(r'^items/(?P<item_name>.+?)/assets/?$',                     views.AssetList.as_view()),
     url(r'^items/(?P<item_name>.+?)/requests/?$',                   views.GetOutstandingRequestsByItem.as_view()),
     url(r'^items/(?P<item_name>.+?)/stacks/?$',                     views.GetItemStacks.as_view()),
+    url(r'^stacks/?$',                                              views.GetItemStacksBatch.as_view()),
     url(r'^items/(?P<item_name>.+?)/loans/?$',                      views.GetLoansByItem.as_view()),
     url(r'^items/(?P<item_name>.+?)/transactions/?$',               views.GetTransactionsByItem.as_view()),
     url(r'^items/(?P<item_name>.+?)/addtocart/?$',                  views.AddItemToCart.as_view()),
@@ -35,6 +36,9 @@ urlpatterns = [
 
     url(r'^loans/?$',                        views.LoanList.as_view()),
     url(r'^loans/all/?$',                    views.LoanListAll.as_view()),
+    url(r'^loans/aging/?$',                  views.LoanAging.as_view()),
+    url(r'^loans/return/?$',                 views.LoanBulkReturn.as_view()),
+    url(r'^loans/convert/?$',                views.LoanBulkConvert.as_view()),
     url(r'^loans/(?P<pk>[\d]+?)/?$',         views.LoanDetailModify.as_view()),
     url(r'^loans/(?P<pk>[\d]+?)/convert/?$', views.ConvertLoanToDisbursement.as_view()),
     url(r'^loans/(?P<loan_id>[\d]+?)/requestforbackfill/?$', views.BackfillRequestCreate.as_view()),
@@ -59,6 +63,7 @@ urlpatterns = [
 
     url(r'^requests/?$',                                            views.RequestListCreate.as_view()),
     url(r'^requests/all/?$',                                        views.RequestListAll.as_view()),
+    url(r'^requests/bulk/?$',                                       views.RequestBulkDecision.as_view()),
     url(r'^requests/(?P<request_pk>[0-9]+?)/?$',                    views.RequestDetailModifyDelete.as_view()),
     url(r'^requests/(?P<request_pk>[0-9]+?)/backfills/?$',          views.GetBackfillsByRequest.as_view()),
     url(r'^requests/(?P<request_pk>[0-9]+?)/backfills/requests/?$', views.GetBackFillRequestsByRequest.as_view()),
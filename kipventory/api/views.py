@@ -3,7 +3,7 @@ from rest_framework import status
 from rest_framework.response import Response
 from rest_framework import authentication, permissions
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.authtoken.models import Token
 from rest_framework.views import APIView
 
@@ -16,39 +16,197 @@ from django.shortcuts import redirect, render, get_object_or_404
 from django.contrib import messages
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.db.models import Q, F
+from django.db import transaction
 import copy
 
-from . import models, serializers
+from . import models, serializers, caches, stock
+from .search import search_items, filter_by_tags, tag_facets, filter_by_custom_values, order_by_custom_value, \
+                    refresh_search_text, CUSTOM_FIELD_PREFIX, CUSTOM_FIELD_LOOKUPS
 from rest_framework import pagination
 from datetime import datetime
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.auth.views import password_reset, password_reset_confirm
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
 import dateutil.parser
-import json, requests, csv, os
+import json, requests, csv, os, base64, math
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.mail import EmailMultiAlternatives
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from django.views.decorators.cache import cache_control
+from django.core.cache import cache
+import hashlib
 from django.conf import settings
 
+# Rows serialized per query when streaming a whole list
+STREAM_CHUNK_SIZE = 500
+# Items per call to the batch stacks endpoint
+MAX_STACKS_BATCH = 100
+
 class CustomPagination(pagination.PageNumberPagination):
     page_query_param = 'page'
     page_size_query_param = 'itemsPerPage'
+    # Passing `cursor` (empty for the first page) switches to keyset pagination,
+    # which doesn't COUNT(*) or OFFSET and so stays fast on deep pages.
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_mode = self.cursor_query_param in request.query_params
+        if not self.cursor_mode:
+            return super(CustomPagination, self).paginate_queryset(queryset, request, view)
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request.query_params.get(self.cursor_query_param))
+        reverse = cursor is not None and cursor.get("reverse", False)
+
+        # Only the count is expensive, so only do it when asked for
+        self.count = None
+        if request.query_params.get(self.count_query_param, False) == "true":
+            self.count = queryset.count()
+            self.num_pages = max(1, math.ceil(self.count / page_size))
+
+        ordering = self.get_keyset_ordering(queryset)
+        if reverse:
+            ordering = [(field, not descending) for field, descending in ordering]
+        queryset = queryset.order_by(*[('-' if descending else '') + field for field, descending in ordering])
+        if cursor is not None:
+            queryset = queryset.filter(self.get_keyset_filter(ordering, cursor["values"]))
+
+        # fetch one extra row to find out whether there is another page
+        rows = list(queryset[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, cursor is not None
+
+        fields = [field for field, descending in ordering]
+        self.next_cursor = self.encode_cursor(rows[-1], fields, False) if (has_next and rows) else None
+        self.previous_cursor = self.encode_cursor(rows[0], fields, True) if (has_previous and rows) else None
+        return rows
+
+    def iterate_chunks(self, queryset, chunk_size):
+        # Walk the whole queryset with keyset pagination, `chunk_size` rows at a time
+        ordering = self.get_keyset_ordering(queryset)
+        fields = [field for field, descending in ordering]
+        queryset = queryset.order_by(*[('-' if descending else '') + field for field, descending in ordering])
+        chunk = list(queryset[:chunk_size])
+        while chunk:
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            values = self.get_cursor_values(chunk[-1], fields)
+            chunk = list(queryset.filter(self.get_keyset_filter(ordering, values))[:chunk_size])
+
+    def get_keyset_ordering(self, queryset):
+        # Page on the queryset's ordering (usually the model's Meta.ordering),
+        # with the primary key as a tie breaker so that every row has a unique position.
+        ordering = list(queryset.query.order_by)
+        if not ordering and queryset.query.default_ordering:
+            ordering = list(queryset.model._meta.ordering)
+        ordering = [(field.lstrip('-'), field.startswith('-')) for field in ordering]
+        if not any(field in ('pk', queryset.model._meta.pk.name) for field, descending in ordering):
+            ordering.append(('pk', ordering[-1][1] if ordering else False))
+        return ordering
+
+    def get_keyset_filter(self, ordering, values):
+        # Rows after (a, b, c): a > A OR (a = A AND b > B) OR (a = A AND b = B AND c > C)
+        q_objs = Q()
+        for i, (field, descending) in enumerate(ordering):
+            q = Q(**{'{}__{}'.format(field, 'lt' if descending else 'gt'): values[i]})
+            for j in range(i):
+                q &= Q(**{ordering[j][0]: values[j]})
+            q_objs |= q
+        return q_objs
+
+    def get_cursor_values(self, row, fields):
+        values = []
+        for field in fields:
+            value = row
+            for attr in field.split('__'):
+                value = getattr(value, attr)
+            values.append(value)
+        return values
+
+    def encode_cursor(self, row, fields, reverse):
+        # isoformat keeps the microseconds (DjangoJSONEncoder would drop them)
+        values = [value.isoformat() if hasattr(value, 'isoformat') else value
+                  for value in self.get_cursor_values(row, fields)]
+        cursor = json.dumps({"values": values, "reverse": reverse}, cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound("Invalid cursor.")
+
+    def get_schema_fields(self, view):
+        fields = super(CustomPagination, self).get_schema_fields(view)
+        fields += [
+          coreapi.Field(name=self.cursor_query_param, description="Page with a cursor instead of page numbers (empty for the first page, then the returned next/previous cursor).", required=False, location='query'),
+          coreapi.Field(name=self.count_query_param, description="Set this to true to include count and num_pages when paging with a cursor.", required=False, location='query'),
+        ]
+        return fields
 
     def get_paginated_response(self, data):
+        if getattr(self, 'cursor_mode', False):
+            d = {
+                "next": self.next_cursor,
+                "previous": self.previous_cursor,
+                "results": data
+            }
+            if self.count is not None:
+                d.update({"count": self.count, "num_pages": self.num_pages})
+            return Response(d)
+
         return Response({
              "count": self.page.paginator.count,
              "num_pages": self.page.paginator.num_pages,
              "results": data
             })
 
+# ETags for the inventory read endpoints. They only change when the inventory
+# version does (see the receivers at the bottom of models.py), so a client that
+# already has the data gets a 304 without anything being queried or serialized.
+# The version is a Counter row bumped with an atomic UPDATE after every commit
+# that changes inventory data (see caches.py), so no change can leave a stale
+# ETag valid. Counters start at the clock in ms, above any version from before.
+def inventoryETag(request, *args, **kwargs):
+    version = caches.get_version(caches.INVENTORY_VERSION, request=request)
+    is_manager = request.user.is_staff or request.user.is_superuser
+    key = "{}:{}:{}".format(version, is_manager, request.get_full_path())
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+# Items also show the user's own cart
+def itemETag(request, *args, **kwargs):
+    cart_version = caches.get_version(caches.cart_version_key(request.user.pk), request=request)
+    key = "{}:{}:{}".format(inventoryETag(request), request.user.pk, cart_version)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+# Browsers have to revalidate every time, and shared caches must not keep the response
+inventory_cache_control = cache_control(private=True, no_cache=True)
+
 class ItemListFilter(BaseFilterBackend):
   def get_schema_fields(self, view):
     fields = [
-      coreapi.Field(name="search", description="Filter by name or model no", required=False, location='query'),
+      coreapi.Field(name="search", description="Search name, model no, description and custom fields (ranked by relevance)", required=False, location='query'),
       coreapi.Field(name="tags", description="Filter by tag (comma separated)", required=False, location='query'),
       coreapi.Field(name="excludeTags", description="Filter by excluding tags (comma separated)", required=False, location='query'),
       coreapi.Field(name="all", description="Set this to true to get all items instead of paginated.", required=False, location='query'),
+      coreapi.Field(name="ndjson", description="With all=true, stream one item per line (NDJSON) instead of a JSON object.", required=False, location='query'),
+      coreapi.Field(name="facets", description="Set this to true to also get the number of matching items for each tag.", required=False, location='query'),
+      coreapi.Field(name="cf.<name>", description="Filter by a custom field value, optionally with __lt, __lte, __gt or __gte (e.g. cf.Price__lt=10)", required=False, location='query'),
+      coreapi.Field(name="ordering", description="Sort by a custom field (cf.<name>, or -cf.<name> for descending)", required=False, location='query'),
     ]
 
     return fields
@@ -72,49 +230,94 @@ class ItemListCreate(generics.GenericAPIView):
         low_stock = self.request.query_params.get("low_stock", False)
         low_stock = True if low_stock == "true" else False
 
-        q_objs = Q()
-
-        # Search filter
+        # Search filter - results come back ranked by relevance
         if search is not None and search != '':
-            q_objs &= (Q(name__icontains=search) | Q(model_no__icontains=search))
-            queryset = queryset.filter(q_objs).order_by('name')
-
-        # Tags filter
-        if include_tags is not None and include_tags != '':
-            tagsArray = include_tags.split(",")
-            for tag in tagsArray:
-                queryset = queryset.filter(tags__name=tag)
+            queryset = search_items(queryset, search)
 
-        # Exclude tags filter
-        if exclude_tags is not None and exclude_tags != '':
-            excludeTagsArray = exclude_tags.split(",")
-            for tag in excludeTagsArray:
-                queryset = queryset.exclude(tags__name=tag)
+        # Tags filter (include and exclude are resolved together)
+        tagsArray = include_tags.split(",") if include_tags else []
+        excludeTagsArray = exclude_tags.split(",") if exclude_tags else []
+        queryset = filter_by_tags(queryset, tagsArray, excludeTagsArray)
 
         # Low stock filter
         if low_stock:
             queryset = queryset.filter(quantity__lte=F('minimum_stock'))
 
+        # Custom field filters and ordering
+        custom_filters = []
+        for key, value in self.request.query_params.items():
+            if key.startswith(CUSTOM_FIELD_PREFIX):
+                name, lookup = key[len(CUSTOM_FIELD_PREFIX):], 'exact'
+                if '__' in name and name.rsplit('__', 1)[1] in CUSTOM_FIELD_LOOKUPS:
+                    name, lookup = name.rsplit('__', 1)
+                custom_filters.append((name, lookup, value))
+        ordering = self.request.query_params.get("ordering", "")
+        if custom_filters or ordering:
+            custom_fields = models.CustomField.objects.all()
+            if not (request.user.is_staff or request.user.is_superuser):
+                custom_fields = custom_fields.filter(private=False)
+            custom_fields = {field.name: field for field in custom_fields}
+
+            try:
+                queryset = filter_by_custom_values(queryset, custom_fields, custom_filters)
+            except ValueError as e:
+                raise ValidationError({"error": [str(e)]})
+
+            if ordering:
+                descending = ordering.startswith('-')
+                name = ordering.lstrip('-')
+                field = custom_fields.get(name[len(CUSTOM_FIELD_PREFIX):], None) if name.startswith(CUSTOM_FIELD_PREFIX) else None
+                if field is None:
+                    raise ValidationError({"error": ["Can't order by '{}'.".format(ordering)]})
+                queryset = order_by_custom_value(queryset, field, descending)
+
         return queryset
 
+    @method_decorator(inventory_cache_control)
+    @method_decorator(condition(etag_func=itemETag))
     def get(self, request, format=None):
         # CHECK PERMISSION
         queryset = self.get_queryset()
+        queryset = self.filter_queryset(queryset, request)
 
         all_items = request.query_params.get('all', False)
         if all_items:
-            serializer = self.get_serializer(instance=queryset, many=True)
-            d = {"count": len(serializer.data), 'num_pages': 1, "results": serializer.data}
-            return Response(d)
-
-        queryset = self.filter_queryset(queryset, request)
+            return self.stream_items(queryset, request)
 
         # Pagination
         paginated_queryset = self.paginate_queryset(queryset)
         serializer = self.get_serializer(instance=paginated_queryset, many=True)
         response = self.get_paginated_response(serializer.data)
+
+        # Per-tag item counts over the whole filtered result
+        if request.query_params.get('facets', False) == "true":
+            response.data['facets'] = tag_facets(queryset)
         return response
 
+    def stream_items(self, queryset, request):
+        # Serialize and send the items a chunk at a time so that memory use stays
+        # flat however big the catalog is. The JSON output has the same shape as
+        # a page (count is sent last), ndjson=true sends one item per line instead.
+        ndjson = request.query_params.get('ndjson', False) == "true"
+        encoder = JSONEncoder()
+
+        def generate():
+            count = 0
+            if not ndjson:
+                yield '{"results": ['
+            for chunk in self.paginator.iterate_chunks(queryset, STREAM_CHUNK_SIZE):
+                data = self.get_serializer(instance=chunk, many=True).data
+                if ndjson:
+                    yield "".join(encoder.encode(item) + "\n" for item in data)
+                else:
+                    yield ("," if count else "") + ",".join(encoder.encode(item) for item in data)
+                count += len(data)
+            if not ndjson:
+                yield '], "count": {}, "num_pages": 1}}'.format(count)
+
+        content_type = "application/x-ndjson" if ndjson else "application/json"
+        return StreamingHttpResponse(generate(), content_type=content_type)
+
     # manager restricted
     def post(self, request, format=None):
         if not (request.user.is_staff or request.user.is_superuser):
@@ -151,6 +354,8 @@ class ItemDetailModifyDelete(generics.GenericAPIView):
     def get_queryset(self):
         return models.Item.objects.all()
 
+    @method_decorator(inventory_cache_control)
+    @method_decorator(condition(etag_func=itemETag))
     def get(self, request, item_name, format=None):
         item = self.get_instance(item_name=item_name)
         serializer = self.get_serializer(instance=item)
@@ -180,18 +385,16 @@ class ItemDetailModifyDelete(generics.GenericAPIView):
             return Response(d, status=status.HTTP_403_FORBIDDEN)
 
         item = self.get_instance(item_name=item_name)
-        assets = models.Asset.objects.filter(item=item)
-        for asset in assets:
-            tag = copy.deepcopy(asset.tag)
-            stat = copy.deepcopy(asset.status)
-            asset.delete()
-            assetDeletionLog(tag, stat, item_name, request.user.pk)
-
-        item.delete()
-        for r in models.Request.objects.all():
-            if (r.requested_items.count() == 0):
-                r.delete()
-        itemDeletionLog(item_name, request.user.pk)
+        with transaction.atomic():
+            assets = list(models.Asset.objects.filter(item=item).values_list('tag', 'status'))
+            assetDeletionLogs(assets, item_name, request.user.pk)
+
+            # only requests for this item can be left empty by deleting it
+            request_pks = list(models.RequestedItem.objects.filter(item=item).values_list('request_id', flat=True).distinct())
+            # the item's assets go with it
+            item.delete()
+            models.Request.objects.filter(pk__in=request_pks, requested_items__isnull=True).delete()
+            itemDeletionLog(item_name, request.user.pk)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 class AssetList(generics.GenericAPIView):
@@ -216,10 +419,12 @@ class AssetList(generics.GenericAPIView):
         # CHECK PERMISSION
         queryset = self.get_queryset()
 
+        status_counts = {status: getattr(item, field) for status, field in models.ASSET_COUNT_FIELDS.items()}
+
         all_assets = request.query_params.get('all', False)
         if all_assets:
             serializer = self.get_serializer(instance=queryset, many=True)
-            d = {"count": len(serializer.data), 'num_pages': 1, "results": serializer.data}
+            d = {"count": len(serializer.data), 'num_pages': 1, "results": serializer.data, "status_counts": status_counts}
             return Response(d)
 
         tag_name = request.query_params.get('search', False)
@@ -242,6 +447,7 @@ class AssetList(generics.GenericAPIView):
         paginated_queryset = self.paginate_queryset(queryset)
         serializer = self.get_serializer(instance=paginated_queryset, many=True)
         response = self.get_paginated_response(serializer.data)
+        response.data['status_counts'] = status_counts
         return response
 
 
@@ -413,7 +619,7 @@ class GetLoansByItem(generics.GenericAPIView):
     filter_backends = (GetLoansByItemFilter,)
 
     def get_queryset(self):
-        return models.Loan.objects.filter(quantity_loaned__gt=F('quantity_returned'))
+        return models.Loan.objects.filter(outstanding=True)
 
     def get_serializer_class(self):
         return serializers.LoanSerializer
@@ -502,50 +708,26 @@ class GetItemStacks(generics.GenericAPIView):
         except models.Item.DoesNotExist:
             raise NotFound("Item '{}' not found.".format(item_name))
 
-        requests = models.Request.objects.filter(status='O', requested_items__item__name=item_name)
-        if not (request.user.is_staff or request.user.is_superuser):
-            requests = requests.filter(requester=request.user.pk)
-        rq = 0
-        for r in requests.all():
-            for ri in r.requested_items.all():
-                if (ri.item.name == item_name):
-                    rq += ri.quantity
-
-        loans = models.Loan.objects.filter(item__name=item_name, quantity_loaned__gt=F('quantity_returned'))
-        if not (request.user.is_staff or request.user.is_superuser):
-            loans = loans.filter(request__requester=request.user.pk)
-        lq = 0
-        for l in loans.all():
-            lq += (l.quantity_loaned - l.quantity_returned)
+        data = stock.item_stacks([item], request.user)[item.pk]
+        return Response(data)
 
-        disbursements = models.Disbursement.objects.filter(item__name=item_name)
-        if not (request.user.is_staff or request.user.is_superuser):
-            disbursements = disbursements.filter(request__requester=request.user.pk)
-        dq = 0
-        for d in disbursements.all():
-            dq += d.quantity
 
-        backfills = models.Backfill.objects.filter(item__name=item_name, status=models.AWAITING_ITEMS)
-        if not (request.user.is_staff or request.user.is_superuser):
-            backfills = backfills.filter(request__requester=request.user.pk)
-        bq = 0
-        for b in backfills:
-            bq += b.quantity
-
-        cart = models.CartItem.objects.filter(owner__pk=request.user.pk, item__name=item_name)
-        cq = 0
-        for c in cart.all():
-            cq += c.quantity
-
-        data = {
-            "in_stock": item.quantity,
-            "requested": rq,
-            "loaned": lq,
-            "disbursed": dq,
-            "awaiting_backfill": bq,
-            "in_cart": cq,
-        }
-        return Response(data)
+class GetItemStacksBatch(generics.GenericAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+
+    # stacks for many items at once, e.g. a page of the inventory
+    def get(self, request, format=None):
+        item_names = request.query_params.getlist('item')
+        if len(item_names) > MAX_STACKS_BATCH:
+            raise ValidationError({"error": ["At most {} items may be requested at once.".format(MAX_STACKS_BATCH)]})
+
+        items = list(models.Item.objects.filter(name__in=item_names))
+        missing = set(item_names) - set(item.name for item in items)
+        if missing:
+            raise NotFound("Item(s) not found: {}.".format(", ".join("'{}'".format(name) for name in sorted(missing))))
+
+        stacks = stock.item_stacks(items, request.user)
+        return Response({item.name: stacks[item.pk] for item in items})
 
 
 class CustomFieldListCreate(generics.GenericAPIView):
@@ -558,6 +740,8 @@ class CustomFieldListCreate(generics.GenericAPIView):
     def get_queryset(self):
         return models.CustomField.objects.all()
 
+    @method_decorator(inventory_cache_control)
+    @method_decorator(condition(etag_func=inventoryETag))
     def get(self, request, format=None):
         queryset = self.get_queryset()
 
@@ -696,7 +880,7 @@ class RequestListAll(generics.GenericAPIView):
     filter_backends = (RequestListAllFilter,)
 
     def get_queryset(self):
-        return models.Request.objects.all()
+        return serializers.RequestSerializer.prefetch(models.Request.objects.all())
 
     def get_serializer_class(self):
         return serializers.RequestSerializer
@@ -709,7 +893,7 @@ class RequestListAll(generics.GenericAPIView):
         queryset = self.get_queryset()
         request_status = request.GET.get('status')
         if not (request_status is None or request_status=="All" or request_status==""):
-            queryset = models.Request.objects.filter(status=request_status)
+            queryset = queryset.filter(status=request_status)
 
         paginated_queryset = self.paginate_queryset(queryset)
         serializer = self.get_serializer(instance=paginated_queryset, many=True)
@@ -732,7 +916,7 @@ class RequestListCreate(generics.GenericAPIView):
 
     # restrict this queryset - each user can only see his/her own Requests
     def get_queryset(self):
-        return models.Request.objects.filter(requester__pk=self.request.user.pk)
+        return serializers.RequestSerializer.prefetch(models.Request.objects.filter(requester__pk=self.request.user.pk))
 
     def get_serializer_class(self):
         return serializers.RequestSerializer
@@ -746,12 +930,8 @@ class RequestListCreate(generics.GenericAPIView):
 
         # Pagination
         paginated_queryset = self.paginate_queryset(queryset)
-        data = []
-        for req in paginated_queryset:
-            data.append(self.get_serializer(instance=req).data)
-
-        # serializer = self.get_serializer(instance=paginated_queryset, many=True)
-        response = self.get_paginated_response(data)
+        serializer = self.get_serializer(instance=paginated_queryset, many=True)
+        response = self.get_paginated_response(serializer.data)
         return response
 
     # generate a request that contains all items currently in your cart.
@@ -759,30 +939,32 @@ class RequestListCreate(generics.GenericAPIView):
         data = request.data.copy()
         data.update({'requester': request.user})
 
-        cart_items = models.CartItem.objects.filter(owner__pk=self.request.user.pk)
-        if cart_items.count() <= 0:
-            d = {"error": ["There are no items in your cart. Add an item to your cart in order to request it."]}
-            return Response(d, status=status.HTTP_400_BAD_REQUEST)
+        # The whole cart is converted in one transaction, so a failure part way
+        # through can't leave it half requested. Locking the cart rows makes a
+        # second checkout of the same cart wait and then find it empty.
+        with transaction.atomic():
+            cart_items = list(models.CartItem.objects.select_for_update().filter(owner__pk=self.request.user.pk))
+            if len(cart_items) <= 0:
+                d = {"error": ["There are no items in your cart. Add an item to your cart in order to request it."]}
+                return Response(d, status=status.HTTP_400_BAD_REQUEST)
 
-        serializer = self.get_serializer(data=data)
-        if serializer.is_valid():
+            serializer = self.get_serializer(data=data)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
             request_instance = serializer.save()
 
-        for ci in cart_items:
-            req_item = models.RequestedItem.objects.create(request=request_instance,
-                                                           item=ci.item,
-                                                           quantity=ci.quantity,
-                                                           request_type=ci.request_type)
-            # Insert Create Log
-            # Need {serializer.data, initiating_user_pk, 'Request Created'}
-            req_item.save()
-            requestItemCreation(req_item, request.user.pk, request_instance)
-            ci.delete()
-
-        #todo maybe combine this with the requsetItemCreationLog method (involves refactoring of logs)
-        sendEmailForNewRequest(request_instance)
-
-        serializer = self.get_serializer(instance=request_instance)
+            items = models.Item.objects.in_bulk([ci.item_id for ci in cart_items])
+            requested_items = [models.RequestedItem(request=request_instance,
+                                                    item=items[ci.item_id],
+                                                    quantity=ci.quantity,
+                                                    request_type=ci.request_type) for ci in cart_items]
+            models.RequestedItem.objects.bulk_create(requested_items)
+            requestItemCreationLogs(requested_items, request.user.pk, request_instance)
+            models.CartItem.objects.filter(pk__in=[ci.pk for ci in cart_items]).delete()
+
+            transaction.on_commit(lambda: sendEmailForNewRequest(request_instance))
+
+        serializer = self.get_serializer(instance=self.get_queryset().get(pk=request_instance.pk))
         return Response(serializer.data)
 
 class RequestDetailModifyDelete(generics.GenericAPIView):
@@ -832,23 +1014,25 @@ class RequestDetailModifyDelete(generics.GenericAPIView):
         serializer = self.get_serializer(instance=instance, data=data, partial=True)
 
         if serializer.is_valid():
-            serializer.save()
-            request_obj = models.Request.objects.get(pk=request_pk)
-            # Check what was done to the request
-            # Could be approved or denied
-            requested_items = models.RequestedItem.objects.filter(request=request_obj)
-            if request_obj.status == 'A':
-                for ri in requested_items:
-                    if ri.request_type == 'loan':
-                        requestItemApprovalLoan(ri, request.user.pk, request_obj)
-                        sendEmailForMinimumStockIfNeeded(ri.item)
-                    else:
-                        requestItemApprovalDisburse(ri, request.user.pk, request_obj)
-                        sendEmailForMinimumStockIfNeeded(ri.item)
+            # the approval (see stock.py) and its logs commit together
+            with transaction.atomic():
+                serializer.save()
+                request_obj = models.Request.objects.get(pk=request_pk)
+                # Check what was done to the request
+                # Could be approved or denied
+                requested_items = models.RequestedItem.objects.filter(request=request_obj).select_related('item')
+                if request_obj.status == 'A':
+                    for ri in requested_items:
+                        if ri.request_type == 'loan':
+                            requestItemApprovalLoan(ri, request.user.pk, request_obj)
+                        else:
+                            requestItemApprovalDisburse(ri, request.user.pk, request_obj)
+                    item_pks = [ri.item_id for ri in requested_items]
+                    transaction.on_commit(lambda: sendEmailsForMinimumStockIfNeeded(item_pks))
 
-            if request_obj.status == 'D':
-                for ri in requested_items:
-                    requestItemDenial(ri, request.user.pk, request_obj)
+                if request_obj.status == 'D':
+                    for ri in requested_items:
+                        requestItemDenial(ri, request.user.pk, request_obj)
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -868,6 +1052,49 @@ class RequestDetailModifyDelete(generics.GenericAPIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class RequestBulkDecision(generics.GenericAPIView):
+    authentication_classes = (authentication.SessionAuthentication,)
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_serializer_class(self):
+        return serializers.BulkRequestDecisionSerializer
+
+    # MANAGER LOCKED - approve and/or deny many outstanding requests at once
+    def post(self, request, format=None):
+        if not (request.user.is_staff or request.user.is_superuser):
+            d = {"error": ["Manager permissions required."]}
+            return Response(d, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = self.get_serializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        decisions = serializer.validated_data['decisions']
+        approvals = [decision for decision in decisions if decision['status'] == models.APPROVED]
+        denials = [decision for decision in decisions if decision['status'] == models.DENIED]
+
+        # Either every decision is applied or none are
+        try:
+            with transaction.atomic():
+                stock.decide_requests(approvals, denials, request.user)
+                requestDecisionLogs(decisions, request.user.pk)
+
+                decided = [decision['request'] for decision in decisions]
+                item_pks = [approved_item['item'].pk for approval in approvals for approved_item in approval['approved_items']]
+                def notify():
+                    sendEmailsForRequestStatusUpdates(decided)
+                    sendEmailsForMinimumStockIfNeeded(item_pks)
+                transaction.on_commit(notify)
+        except stock.ApprovalError as e:
+            return Response(e.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        d = {
+            "approved": [approval['request'].pk for approval in approvals],
+            "denied": [denial['request'].pk for denial in denials],
+        }
+        return Response(d)
+
+
 class GetBackfillsByRequest(generics.GenericAPIView):
     permissions = (permissions.IsAuthenticated,)
     pagination_class = CustomPagination
@@ -999,13 +1226,13 @@ class GetLoansByRequest(generics.GenericAPIView):
         loan_status = request.query_params.get('status', "").lower().strip()
         if loan_status != "":
             if (loan_status == "outstanding"):
-                loans = loans.filter(quantity_loaned__gt=F('quantity_returned')).distinct()
+                loans = loans.filter(outstanding=True)
             elif (loan_status == "returned"):
-                loans = loans.filter(quantity_loaned=F('quantity_returned')).distinct()
+                loans = loans.filter(outstanding=False)
 
         item = request.query_params.get('item', "")
         if item != "":
-            loans = loans.filter(item__name__icontains=item).distinct()
+            loans = loans.filter(item__name__icontains=item)
 
         # Pagination
         paginated_queryset = self.paginate_queryset(loans)
@@ -1085,28 +1312,45 @@ class LoanListAll(generics.GenericAPIView):
         if not (request.user.is_staff or request.user.is_superuser):
             return Response({"error": ["Manager permissions required."]}, status=status.HTTP_403_FORBIDDEN)
 
-        requests = self.get_queryset()
+        requests = serializers.RequestLoanDisbursementSerializer.prefetch(self.get_queryset())
 
+        # Loan conditions are IN subqueries or the per-request loan counts, so no DISTINCT is needed
         item_search = request.query_params.get('item', "")
         if item_search != "":
-            requests = requests.filter(loans__item__name__icontains=item_search).distinct()
+            requests = requests.filter(pk__in=models.Loan.objects.filter(item__name__icontains=item_search).values('request_id'))
 
         status = request.query_params.get('status', "")
         if status != "":
             if (status.lower().strip() == "returned"):
-                requests = requests.exclude(loans__quantity_loaned__gt=F('loans__quantity_returned')).distinct()
+                requests = requests.filter(outstanding_loans=0)
             elif (status.lower().strip() == "outstanding"):
-                requests = requests.exclude(loans__quantity_loaned__lte=F('loans__quantity_returned')).distinct()
+                requests = requests.filter(returned_loans=0)
 
         user = request.query_params.get('user', "")
         if user != "":
-            requests = requests.filter(requester__username__icontains=user).distinct()
+            requests = requests.filter(requester__username__icontains=user)
 
         requests = self.paginate_queryset(requests)
         serializer = self.get_serializer(instance=requests, many=True)
         response = self.get_paginated_response(serializer.data)
         return response
 
+class LoanAging(generics.GenericAPIView):
+    authentication_classes = (authentication.SessionAuthentication,)
+    permission_classes = (permissions.IsAuthenticated,)
+
+    # MANAGER LOCKED - how long outstanding loans have been out
+    def get(self, request, format=None):
+        if not (request.user.is_staff or request.user.is_superuser):
+            return Response({"error": ["Manager permissions required."]}, status=status.HTTP_403_FORBIDDEN)
+
+        # the same for every manager, so share it for a little while
+        data = cache.get(caches.LOAN_AGING)
+        if data is None:
+            data = stock.loan_aging()
+            cache.set(caches.LOAN_AGING, data, getattr(settings, 'LOAN_AGING_CACHE_SECONDS', 60))
+        return Response(data)
+
 class LoanListFilter(BaseFilterBackend):
   def get_schema_fields(self, view):
     fields = [
@@ -1129,22 +1373,23 @@ class LoanList(generics.GenericAPIView):
         return serializers.RequestLoanDisbursementSerializer
 
     def get(self, request, format=None):
-        queryset = self.get_queryset()
+        queryset = serializers.RequestLoanDisbursementSerializer.prefetch(self.get_queryset())
 
+        # see LoanListAll
         item_search = request.query_params.get('item', "")
         if item_search != "":
-            queryset = queryset.filter(loans__item__name__icontains=item_search).distinct()
+            queryset = queryset.filter(pk__in=models.Loan.objects.filter(item__name__icontains=item_search).values('request_id'))
 
         status = request.query_params.get('status', "")
         if status != "":
             if (status.lower().strip() == "returned"):
-                queryset = queryset.filter(loans__quantity_loaned__lte=F('loans__quantity_returned')).distinct()
+                queryset = queryset.filter(returned_loans__gt=0)
             elif (status.lower().strip() == "outstanding"):
-                queryset = queryset.filter(loans__quantity_loaned__gt=F('loans__quantity_returned')).distinct()
+                queryset = queryset.filter(outstanding_loans__gt=0)
 
         user = request.query_params.get('user', "")
         if user != "":
-            queryset = queryset.filter(requester__username=user).distinct()
+            queryset = queryset.filter(requester__username=user)
 
         queryset = self.paginate_queryset(queryset)
         serializer = self.get_serializer(instance=queryset, many=True)
@@ -1201,6 +1446,33 @@ class LoanDetailModify(generics.GenericAPIView):
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class LoanBulkReturn(generics.GenericAPIView):
+    authentication_classes = (authentication.SessionAuthentication,)
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_serializer_class(self):
+        return serializers.BulkLoanReturnSerializer
+
+    # MANAGER LOCKED - mark many loans as (partially) returned at once
+    def post(self, request, format=None):
+        if not (request.user.is_superuser or request.user.is_staff):
+            d = {"error": ["Manager permissions required."]}
+            return Response(d, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = self.get_serializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            with transaction.atomic():
+                returned = stock.return_loans(serializer.validated_data['returns'], request.user)
+                requestItemLoanModifyLogs(returned, request.user.pk)
+                transaction.on_commit(lambda: sendEmailsForLoanChanges(returned, "Loan Returned", "marked as returned"))
+        except stock.ReturnError as e:
+            return Response(e.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"returned": [loan.pk for loan in returned]})
+
 class ConvertLoanToDisbursement(generics.GenericAPIView):
     authentication_classes = (authentication.SessionAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
@@ -1246,6 +1518,34 @@ class ConvertLoanToDisbursement(generics.GenericAPIView):
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class LoanBulkConvert(generics.GenericAPIView):
+    authentication_classes = (authentication.SessionAuthentication,)
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_serializer_class(self):
+        return serializers.BulkConversionSerializer
+
+    # MANAGER LOCKED - convert many loans to disbursements at once
+    def post(self, request, format=None):
+        if not (request.user.is_superuser or request.user.is_staff):
+            d = {"error": ["Manager permissions required."]}
+            return Response(d, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = self.get_serializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            with transaction.atomic():
+                converted = stock.convert_loans(serializer.validated_data['conversions'], request.user)
+                requestItemLoantoDisburseLogs(converted, request.user.pk)
+                loans = [loan for loan, quantity in converted]
+                transaction.on_commit(lambda: sendEmailsForLoanChanges(loans, "Loan To Disbursement", "converted to disbursements"))
+        except stock.ConversionError as e:
+            return Response(e.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"converted": [loan.pk for loan in loans]})
+
 def approveBackfillRequest(backfill_request, request_user_pk):
     loan = backfill_request.loan
     quantity = loan.quantity_loaned - loan.quantity_returned # change this if want to implement partial backfills
@@ -1466,6 +1766,8 @@ class TagListCreate(generics.GenericAPIView):
     def get_queryset(self):
         return models.Tag.objects.all()
 
+    @method_decorator(inventory_cache_control)
+    @method_decorator(condition(etag_func=inventoryETag))
     def get(self, request, format=None):
         tags = self.get_queryset()
 
@@ -1827,6 +2129,8 @@ class BulkImport(generics.GenericAPIView):
             # we know we've passed the validation check - go ahead and make all the items
             created_items = []
             created_tags  = []
+            searchable_changed = []
+            custom_fields = list(models.CustomField.objects.filter(name__in=list(indices.keys())))
             for i in range(numRows):
                 # create the base item
                 item = models.Item(name=names[i], model_no=model_nos[i], quantity=quantities[i], description=descriptions[i], minimum_stock=minimum_stocks[i], has_assets=have_assets[i])
@@ -1846,16 +2150,17 @@ class BulkImport(generics.GenericAPIView):
                 item.save()
 
                 # set custom field values on created item
-                for custom_value in item.values.all():
-                    field_index = indices[custom_value.field.name]
-                    val = contents[i][field_index]
-                    setattr(custom_value, custom_value.field.field_type, val)
-                    custom_value.save()
+                for cf in custom_fields:
+                    if models.set_custom_value(item.values, cf, contents[i][indices[cf.name]]):
+                        searchable_changed.append(item.pk)
                 item.save()
-                created_items.append(item.name)
+                created_items.append(item)
+
+            models.refresh_packed_values(models.Item, [item.pk for item in created_items])
+            refresh_search_text(searchable_changed)
 
             d = {
-                    "items" : [name for name in created_items],
+                    "items" : [item.name for item in created_items],
                     "tags"  : [tag  for tag  in created_tags]
                 }
 
@@ -1932,40 +2237,37 @@ class DisburseCreate(generics.GenericAPIView):
         if errors:
             return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
-        # if we made it here, we know we can go ahead and create the request, all the request items, and approve it
+        # if we made it here, create the request and approve it. stock.py locks the
+        # items and assets and checks the stock again, so a concurrent approval
+        # can't oversell; if it fails the request is rolled back with it.
         serializer = self.get_serializer(data=data)
         if serializer.is_valid():
-            request_instance = serializer.save()
-
-            data = {}
-            data.update({'administrator': request.user})
-            data.update({'closed_comment': closed_comment})
-            data.update({'status': 'A'})
-
-            request_instance.administrator = request.user
-            request_instance.closed_comment = closed_comment
-            request_instance.status = 'A'
-            request_instance.save()
-
-            for item, quantity, request_type, assets in zip(items, quantities, types, selectedAssets):
-                # Create request item
-                req_item = models.ApprovedItem(item=item, quantity=quantity, request_type=request_type, request=request_instance)
-                req_item.save(assets=assets)
-
-                # Decrement the quantity remaining on the Item
-                item.quantity -= quantity
-                item.save()
-
-                # Logging
-                requestItemCreation(req_item, request.user.pk, request_instance)
-                if req_item.request_type == 'loan':
-                    requestItemApprovalLoan(req_item, request.user.pk, request_instance)
-                    sendEmailForMinimumStockIfNeeded(req_item.item)
-                else:
-                    requestItemApprovalDisburse(req_item, request.user.pk, request_instance)
-                    sendEmailForMinimumStockIfNeeded(req_item.item)
-
-            sendEmailForNewDisbursement(requester, request_instance)
+            approved_items = [{"item": item, "quantity": quantity, "request_type": request_type, "assets": list(assets)}
+                              for item, quantity, request_type, assets in zip(items, quantities, types, selectedAssets)]
+            try:
+                with transaction.atomic():
+                    request_instance = serializer.save()
+                    req_items = stock.approve_requests([{"request": request_instance,
+                                                         "approved_items": approved_items,
+                                                         "closed_comment": closed_comment}],
+                                                       request.user)
+                    request_instance.refresh_from_db()
+
+                    # Logging
+                    for req_item in req_items:
+                        requestItemCreation(req_item, request.user.pk, request_instance)
+                        if req_item.request_type == models.LOAN:
+                            requestItemApprovalLoan(req_item, request.user.pk, request_instance)
+                        else:
+                            requestItemApprovalDisburse(req_item, request.user.pk, request_instance)
+
+                    item_pks = [item.pk for item in items]
+                    def notify():
+                        sendEmailsForMinimumStockIfNeeded(item_pks)
+                        sendEmailForNewDisbursement(requester, request_instance)
+                    transaction.on_commit(notify)
+            except stock.ApprovalError as e:
+                return Response(e.errors, status=status.HTTP_400_BAD_REQUEST)
             return Response(serializer.data)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -1990,31 +2292,34 @@ def itemCreationLog(data, initiating_user_pk):
     log.save()
 
 def assetCreationLog(assets, initiating_user_pk):
-    for asset in assets:
+    try:
+        initiating_user = User.objects.get(pk=initiating_user_pk)
+    except User.DoesNotExist:
+        raise NotFound('User not found.')
+    logs = []
+    for asset in assets.select_related('item'):
         item = asset.item
-        quantity = 1
-        asset = asset
-        try:
-            initiating_user = User.objects.get(pk=initiating_user_pk)
-        except User.DoesNotExist:
-            raise NotFound('User not found.')
-        affected_user = None
         message = 'Asset {} created by {}'.format(asset, initiating_user)
-        log = models.Log(item=item, initiating_user=initiating_user, quantity=quantity, category='Asset Creation', message=message, affected_user=affected_user)
-        log.save()
-
-def assetDeletionLog(tag, status, item_name, initiating_user_pk):
-    item = None
-    initiating_user = None
-    quantity = None
-    affected_user = None
+        log = models.Log(item=item, initiating_user=initiating_user, quantity=1, category='Asset Creation', message=message, affected_user=None)
+        # bulk_create skips Log.save()
+        log.createDefaults()
+        logs.append(log)
+    models.Log.objects.bulk_create(logs)
+
+def assetDeletionLogs(assets, item_name, initiating_user_pk):
+    # log the deletion of many assets, given as (tag, status) pairs, in one query
     try:
         initiating_user = User.objects.get(pk=initiating_user_pk)
     except User.DoesNotExist:
         raise NotFound('User not found.')
-    message = 'Asset {} for item {} deleted by {}'.format(tag, item_name, initiating_user)
-    log = models.Log(item=item, initiating_user=initiating_user, quantity=quantity, category='Asset Deletion', message=message, affected_user=affected_user)
-    log.save()
+    logs = []
+    for tag, asset_status in assets:
+        message = 'Asset {} for item {} deleted by {}'.format(tag, item_name, initiating_user)
+        log = models.Log(item=None, initiating_user=initiating_user, quantity=None, category='Asset Deletion', message=message, affected_user=None)
+        # bulk_create skips Log.save()
+        log.createDefaults()
+        logs.append(log)
+    models.Log.objects.bulk_create(logs)
 
 def assetModificationLog(asset, previous_tag, initiating_user_pk):
     item = asset.item
@@ -2079,6 +2384,20 @@ def requestItemCreation(request_item, initiating_user_pk, requestObj):
     log = models.Log(item=item, initiating_user=initiating_user, request=request, quantity=quantity, category='Request Item Creation', message=message, affected_user=affected_user)
     log.save()
 
+def requestItemCreationLogs(request_items, initiating_user_pk, requestObj):
+    try:
+        initiating_user = User.objects.get(pk=initiating_user_pk)
+    except User.DoesNotExist:
+        raise NotFound('User not found.')
+    logs = []
+    for request_item in request_items:
+        message = 'Request Item for item {} created by {}'.format(request_item.item.name, initiating_user)
+        log = models.Log(item=request_item.item, initiating_user=initiating_user, request=requestObj, quantity=request_item.quantity, category='Request Item Creation', message=message, affected_user=None)
+        # bulk_create skips Log.save()
+        log.createDefaults()
+        logs.append(log)
+    models.Log.objects.bulk_create(logs)
+
 def backfillRequestApproveLog(backfill_request, backfill, initiating_user_pk):
     item = backfill.item
     initiating_user = None
@@ -2210,8 +2529,8 @@ def sendEmailForNewBackfillRequest(backfill_request):
 def getItemQuantity(item):
     # todo is this correct?
     if item.has_assets:
-        assets_in_stock = item.assets.filter(status=models.IN_STOCK)
-        quantity = len(assets_in_stock)
+        # read the counter from the database, `item` may be older than the last asset change
+        quantity = models.Item.objects.filter(pk=item.pk).values_list('assets_in_stock', flat=True).first() or 0
     else:
         quantity = item.quantity
     return quantity
@@ -2224,6 +2543,11 @@ def sendEmailForMinimumStockIfNeeded(item):
     if quantity < item.minimum_stock:
         sendEmailForMinimumStock(item, quantity)
 
+def sendEmailsForMinimumStockIfNeeded(item_pks):
+    # for after a commit, when the instances we had may be stale
+    for item in models.Item.objects.filter(pk__in=item_pks):
+        sendEmailForMinimumStockIfNeeded(item)
+
 def sendEmailForMinimumStock(item, quantity):
     subscribed_managers = User.objects.filter(is_staff=True).filter(profile__subscribed=True)
 
@@ -2257,6 +2581,19 @@ def sendEmailForLoanModification(loan):
     to_emails = [user.email]
     sendEmail(subject, text_content, html_content, to_emails)
 
+def sendEmailsForLoanChanges(loans, subject, change):
+    # sendEmailForLoanModification/sendEmailForLoanToDisbursementConversion,
+    # but one email per borrower, e.g. change="marked as returned"
+    by_user = {}
+    for loan in loans:
+        requester = loan.request.requester
+        by_user.setdefault(requester.pk, (requester, []))[1].append(loan)
+    for user, user_loans in by_user.values():
+        request_urls = ["{}{}".format(REQUESTS_URL, request_id) for request_id in sorted(set(loan.request.id for loan in user_loans))]
+        text_content = "{} of your loans have been {}. Check the following for details:\n{}".format(len(user_loans), change, "\n".join(request_urls))
+        html_content = "{} of your loans have been {}. Check the following for details:<ul>{}</ul>".format(len(user_loans), change, "".join("<li><a href='{}'>{}</a></li>".format(url, url) for url in request_urls))
+        sendEmail(subject, text_content, html_content, [user.email])
+
 def sendEmailForNewDisbursement(user, request):
     subject = "New Disbursement"
     request_url = "{}{}".format(REQUESTS_URL, request.id)
@@ -2274,6 +2611,18 @@ def sendEmailForRequestStatusUpdate(request):
     to_emails = [user.email]
     sendEmail(subject, text_content, html_content, to_emails)
 
+def sendEmailsForRequestStatusUpdates(requests):
+    # One email per requester, however many of their requests changed
+    by_user = {}
+    for request in requests:
+        by_user.setdefault(request.requester.pk, (request.requester, []))[1].append(request)
+    subject = "Request Status Update"
+    for user, user_requests in by_user.values():
+        request_urls = ["{}{}".format(REQUESTS_URL, request.id) for request in user_requests]
+        text_content = "The status of {} of your requests has changed. Go to the following to view them:\n{}".format(len(user_requests), "\n".join(request_urls))
+        html_content = "The status of {} of your requests has changed. Go to the following to view them:<ul>{}</ul>".format(len(user_requests), "".join("<li><a href='{}'>{}</a></li>".format(url, url) for url in request_urls))
+        sendEmail(subject, text_content, html_content, [user.email])
+
 def sendEmailForNewRequest(request):
     user = request.requester
     request_items = models.RequestedItem.objects.filter(request=request)
@@ -2308,6 +2657,35 @@ def sendEmail(subject, text_content, html_content, to_emails, bcc_emails=[]):
     msg.attach_alternative(html_content, "text/html")
     msg.send()
 
+def requestDecisionLogs(decisions, initiating_user_pk):
+    # requestItemApprovalLoan/requestItemApprovalDisburse for the approved items and
+    # requestItemDenial for the requested items of denied requests, written in one query
+    try:
+        initiating_user = User.objects.get(pk=initiating_user_pk)
+    except User.DoesNotExist:
+        raise NotFound('User not found.')
+    denied = {decision['request'].pk: decision['request'] for decision in decisions if decision['status'] == models.DENIED}
+    entries = []
+    for decision in decisions:
+        if decision['status'] == models.APPROVED:
+            entries.extend((decision['request'], ai['item'], ai['quantity'], ai.get('request_type', models.LOAN)) for ai in decision['approved_items'])
+    for ri in models.RequestedItem.objects.filter(request__pk__in=list(denied.keys())).select_related('item'):
+        entries.append((denied[ri.request_id], ri.item, ri.quantity, None))
+
+    logs = []
+    for request, item, quantity, request_type in entries:
+        if request_type is None:
+            category = 'Request Item Denial'
+            message = 'Request Item for item {} denied by {}'.format(item.name, initiating_user.username)
+        else:
+            category = 'Request Item Approval: Loan' if request_type == models.LOAN else 'Request Item Approval: Disburse'
+            message = 'Request Item for item {} approved by {} as a {}'.format(item.name, initiating_user.username, category)
+        log = models.Log(item=item, request=request, initiating_user=initiating_user, quantity=quantity, category=category, message=message, affected_user=request.requester)
+        # bulk_create skips Log.save()
+        log.createDefaults()
+        logs.append(log)
+    models.Log.objects.bulk_create(logs)
+
 def requestItemDenial(request_item, initiating_user_pk, requestObj):
     item = request_item.item
     initiating_user = None
@@ -2369,6 +2747,24 @@ def requestItemLoanModify(loan, initiating_user_pk):
     log = models.Log(item=item, request=request, initiating_user=initiating_user, quantity=quantity, category=category, message=message, affected_user=affected_user)
     log.save()
 
+def requestItemLoanModifyLogs(loans, initiating_user_pk):
+    # requestItemLoanModify for many loans in one query
+    try:
+        initiating_user = User.objects.get(pk=initiating_user_pk)
+    except User.DoesNotExist:
+        raise NotFound('User not found.')
+    logs = []
+    for loan in loans:
+        if loan.asset == None:
+            message = 'Loan for item {} modified. The number of items returned by {} is now {}. The total number loaned is {}'.format(loan.item.name, initiating_user.username, loan.quantity_returned, loan.quantity_loaned - loan.quantity_returned)
+        else:
+            message = 'Loan for asset {} has been marked as returned by {}'.format(loan.asset, initiating_user.username)
+        log = models.Log(item=loan.item, request=loan.request, initiating_user=initiating_user, quantity=loan.quantity_returned, category='Request Item Loan Modify', message=message, affected_user=loan.request.requester)
+        # bulk_create skips Log.save()
+        log.createDefaults()
+        logs.append(log)
+    models.Log.objects.bulk_create(logs)
+
 def backfillRequestCreateLog(backfill_request, initiating_user_pk):
     item = backfill_request.item
     try:
@@ -2403,6 +2799,21 @@ def requestItemLoantoDisburse(loan, user, num_disbursed):
     log = models.Log(item=item, request=request, initiating_user=initiating_user, quantity=quantity, category=category, message=message, affected_user=affected_user)
     log.save()
 
+def requestItemLoantoDisburseLogs(conversions, user):
+    # requestItemLoantoDisburse for many (loan, quantity) pairs in one query
+    try:
+        initiating_user = User.objects.get(pk=user)
+    except User.DoesNotExist:
+        raise NotFound('User not found.')
+    logs = []
+    for loan, quantity in conversions:
+        message = 'Loan for item {} modified. {} items have been disbursed from a loan by {}. The number still loaned is {}.'.format(loan.item.name, quantity, initiating_user.username, loan.quantity_loaned - loan.quantity_returned)
+        log = models.Log(item=loan.item, request=loan.request, initiating_user=initiating_user, quantity=quantity, category='Request Item Loan Changed to Disburse', message=message, affected_user=loan.request.requester)
+        # bulk_create skips Log.save()
+        log.createDefaults()
+        logs.append(log)
+    models.Log.objects.bulk_create(logs)
+
 def requestItemApprovalDisburse(request_item, initiating_user_pk, requestObj):
     item = request_item.item
     initiating_user = None
@@ -13,4 +13,5 @@ rm -r ./kipventory/api/migrations/__pycache__/
 python kipventory/manage.py flush --noinput
 python kipventory/manage.py makemigrations
 python kipventory/manage.py migrate
+python kipventory/manage.py createcachetable
 python kipventory/manage.py createsuperuser